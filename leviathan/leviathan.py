@@ -54,7 +54,16 @@
 
 import codecs
 import collections
-import ConfigParser as configparser
+import contextlib
+import errno
+import fcntl
+import filecmp
+import hashlib
+import io
+import itertools
+import json
+import multiprocessing
+import multiprocessing.pool
 import os
 import re
 import shutil
@@ -63,10 +72,16 @@ import stat
 import string
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 import traceback
 import types
 import UserDict
 import unicodedata
+import urllib
+import xml.etree.cElementTree as ElementTree
+import xml.sax.saxutils
 
 import yaml
 
@@ -81,15 +96,69 @@ Mutagen will not be imported unless this function was called first.
 
 _GPL = False
 
+# Database connections that a parent process opened before it forked, which
+# are kept referenced so that they are never closed (see Library._connect)
+_inherited_connections = []
+
 Format = collections.namedtuple("Format", ["ffmpeg_codec"])
 
 # DB version changelog:
-# 3 - added disc_number and track_number fields to songs table
+# 7 - added content_hash field and index to songs table (filled in by the
+#     next scan)
+# 6 - added songs_search full-text index (only if SQLite supports FTS5)
+# 5 - added indexes for browsing and lookups by artist, album, and title;
+#     playlist_entries_playlist index replaced with playlist_entries_playlist_song
+# 4 - added mtime, size, and inode fields to songs table (filled in by the
+#     next scan, which rereads every song that does not have them)
+# 3 - added disc_number and track_number fields to songs table (filled in by
+#     the next scan, since migration 4 leaves every song without a fingerprint)
 # 2 - added length field to songs table
 # 1.1 - leviathan_meta "key" field made UNIQUE
 # 1 - initial version
-DB_VERSION = "3"
+DB_VERSION = "7"
+# How long (in seconds) a connection waits for another process's lock on the
+# database before giving up with "database is locked"
+DB_BUSY_TIMEOUT = 30.0
+# Maximum number of bytes of the database file that each connection maps into
+# memory for reading (0 disables memory-mapped I/O)
+DB_MMAP_SIZE = 64 * 1024 * 1024
+# How often (in seconds) each connection checks whether the database file was
+# replaced (e.g. deleted and recreated) and needs to be reopened
+DB_REPLACED_CHECK_INTERVAL = 1.0
 DISC_TRACK_NUMBER_RE = re.compile(r"[^0-9]", re.MULTILINE)
+# Matches the keys of the song paths in PLS playlist files
+PLS_FILE_KEY_RE = re.compile(r"^file\d+$", re.IGNORECASE)
+# Matches EXPLAIN QUERY PLAN details for steps that read an entire table
+FULL_SCAN_RE = re.compile(r"^SCAN (?:TABLE )?(\w+)(?: \(~\d+ rows\))?$")
+# Number of rows fetched at a time by Library.iter_query
+QUERY_FETCH_SIZE = 500
+# Number of rows changed per transaction inside Library.bulk blocks
+BULK_BATCH_SIZE = 1000
+# Number of files sent to each scan worker process at a time
+SCAN_CHUNK_SIZE = 16
+# Number of files whose tags are read between the scan checkpoints that are
+# saved in the database for `scan --resume` and the Web app
+SCAN_CHECKPOINT_INTERVAL = 100
+# Largest fraction of the songs in the database that a scan or the watcher
+# removes because their files are missing, unless pruning is forced; more
+# usually means that the music folder (e.g. a network share) is not mounted
+SCAN_PRUNE_MAX_FRACTION = 0.5
+# How often (in seconds) the scan command prints its progress to a terminal,
+# or to a file or pipe
+SCAN_PROGRESS_INTERVAL = 1.0
+SCAN_PROGRESS_LOG_INTERVAL = 60.0
+# Number of bytes read from each end of a song file for its content hash
+CONTENT_HASH_BLOCK_SIZE = 16 * 1024
+# LibraryWatcher applies changes once no new ones have come in for
+# WATCH_DEBOUNCE seconds, or WATCH_MAX_DELAY seconds after the first one
+WATCH_DEBOUNCE = 2.0
+WATCH_MAX_DELAY = 10.0
+# How often (in seconds) LibraryWatcher checks for changes without inotify
+WATCH_POLL_INTERVAL = 30.0
+# Number of files that mvdir copies at a time between filesystems
+MOVE_COPY_THREADS = 4
+# Number of strings whose sort values are remembered by sort_value
+SORT_VALUE_CACHE_SIZE = 4096
 EXTENSIONS = dict(
  aac  = Format("libfaac"),
  flac = Format("flac"),
@@ -100,6 +169,10 @@ EXTENSIONS = dict(
  wav  = Format("pcm_s16le"),
  wma  = Format("wmav2")
 )
+# Number of prepared statements kept per database connection.  This should be
+# larger than the number of distinct queries in all of the `queries` dicts so
+# that none of them have to be recompiled.
+STATEMENT_CACHE_SIZE = 256
 
 
 class Albums(object):
@@ -107,6 +180,37 @@ class Albums(object):
   "all_albums_and_artists": """SELECT album, artist FROM songs
                                GROUP BY album, artist
                                ORDER BY sort_album, sort_artist""",
+  "count": """SELECT COUNT(*) FROM
+               (SELECT 1 FROM songs GROUP BY album, artist)""",
+  "all_songs_by_album_and_artist": """SELECT
+                                       songs.id,relpath,title,sort_title,
+                                       artist,sort_artist,album,sort_album,
+                                       length,disc_number,track_number
+                                      FROM songs INNER JOIN
+                                       (SELECT album, artist,
+                                         MIN(sort_album) AS album_key,
+                                         MIN(sort_artist) AS artist_key
+                                        FROM songs GROUP BY album, artist)
+                                       USING (album, artist)
+                                      ORDER BY
+                                       album_key, artist_key, album, artist,
+                                       disc_number, track_number, sort_title,
+                                       sort_artist, sort_album, length""",
+  "all_songs_by_album_from_artist": """SELECT
+                                        songs.id,relpath,title,sort_title,
+                                        artist,sort_artist,album,sort_album,
+                                        length,disc_number,track_number
+                                       FROM songs INNER JOIN
+                                        (SELECT album, artist,
+                                          MIN(sort_album) AS album_key,
+                                          MIN(sort_artist) AS artist_key
+                                         FROM songs WHERE artist = :artist
+                                         GROUP BY album, artist)
+                                        USING (album, artist)
+                                       ORDER BY
+                                        album_key, artist_key, album, artist,
+                                        disc_number, track_number, sort_title,
+                                        sort_artist, sort_album, length""",
   "album_and_artist_from_both": """SELECT album, artist FROM songs WHERE
                                     album = :album AND artist = :artist
                                    ORDER BY sort_album, sort_artist""",
@@ -114,11 +218,15 @@ class Albums(object):
                                        artist = :artist
                                       GROUP BY album, artist
                                       ORDER BY sort_album, sort_artist""",
-  "song_ids_from_album_and_artist": """SELECT id FROM songs WHERE
-                                        album = :album AND artist = :artist
-                                       ORDER BY
-                                        disc_number, track_number, sort_title,
-                                        sort_artist, sort_album, length"""
+  "songs_from_album_and_artist": """SELECT
+                                     id,relpath,title,sort_title,artist,
+                                     sort_artist,album,sort_album,length,
+                                     disc_number,track_number
+                                    FROM songs WHERE
+                                     album = :album AND artist = :artist
+                                    ORDER BY
+                                     disc_number, track_number, sort_title,
+                                     sort_artist, sort_album, length"""
  }
  Album = collections.namedtuple("Album", "name artist library songs")
  
@@ -126,7 +234,7 @@ class Albums(object):
   self.library = library
  
  def __len__(self):
-  return len(self.library.query(self.queries["all_albums_and_artists"]))
+  return self.library.query(self.queries["count"])[0][0]
  
  def __call__(self, artist=None, album=None):
   if not isinstance(artist, (basestring, types.NoneType)):
@@ -159,20 +267,20 @@ class Albums(object):
  def __getitem__(self, item):
   if isinstance(item, basestring):
    item = to_unicode(item)
-   q = self.queries["albums_and_artist_from_artist"]
-   r = self.library.query(q, artist=item)
+   q = self.queries["all_songs_by_album_from_artist"]
+   r = list(self._iter_albums(self.library.iter_query(q, artist=item)))
    if not len(r):
     raise IndexError("no aritst named '%s'" % item)
-   return [self[i] for i in r if i]
+   return r
   elif isinstance(item, (int, long)):
    return self[self.names[item]]
   elif isinstance(item, (list, tuple)):
    item = [to_unicode(i) for i in item]
-   q = self.queries["song_ids_from_album_and_artist"]
+   q = self.queries["songs_from_album_and_artist"]
    r = self.library.query(q, artist=item[1], album=item[0])
    if not len(r):
     raise IndexError("no album named '%s' by artist '%s'" % tuple(item))
-   songs = tuple([Song(self.library, i[0]) for i in r if i])
+   songs = tuple(self.library.songs._parse_songs(r))
    return self.Album(name=item[0], artist=item[1], library=self.library,
                      songs=songs)
   elif isinstance(item, slice):
@@ -181,8 +289,16 @@ class Albums(object):
    raise TypeError("item must be a string, integer, list, slice, or tuple")
  
  def __iter__(self):
-  for i in self.names:
-   yield self[i]
+  q = self.queries["all_songs_by_album_and_artist"]
+  return self._iter_albums(self.library.iter_query(q))
+ 
+ def _iter_albums(self, result):
+  # Makes Album objects from a SQL query result whose rows are songs ordered
+  # by album and artist
+  for key, rows in itertools.groupby(result, lambda i: (i[6], i[4])):
+   songs = tuple(Song._from_row(self.library, i) for i in rows)
+   yield self.Album(name=key[0], artist=key[1], library=self.library,
+                    songs=songs)
  
  @property
  def names(self):
@@ -194,11 +310,26 @@ class Artists(object):
  queries = {
   "all_artists": """SELECT artist FROM songs
                     GROUP BY artist ORDER BY sort_artist""",
+  "all_songs_by_artist": """SELECT
+                             songs.id,relpath,title,sort_title,artist,
+                             sort_artist,album,sort_album,length,disc_number,
+                             track_number
+                            FROM songs INNER JOIN
+                             (SELECT artist, MIN(sort_artist) AS artist_key
+                              FROM songs GROUP BY artist)
+                             USING (artist)
+                            ORDER BY
+                             artist_key, artist, sort_title, sort_artist,
+                             sort_album, length""",
   "artist_from_artist": """SELECT artist FROM songs WHERE artist = :artist
                            GROUP BY artist ORDER BY sort_artist""",
-  "song_ids_from_artist": """SELECT id FROM songs WHERE artist = :artist
-                             ORDER BY
-                              sort_title, sort_artist, sort_album, length"""
+  "count": """SELECT COUNT(*) FROM (SELECT 1 FROM songs GROUP BY artist)""",
+  "songs_from_artist": """SELECT
+                           id,relpath,title,sort_title,artist,sort_artist,
+                           album,sort_album,length,disc_number,track_number
+                          FROM songs WHERE artist = :artist
+                          ORDER BY
+                           sort_title, sort_artist, sort_album, length"""
  }
  Artist = collections.namedtuple("Artist", "name library songs")
  class Artist(Artist):
@@ -210,7 +341,7 @@ class Artists(object):
   self.library = library
  
  def __len__(self):
-  return len(self.library.query(self.queries["all_artists"]))
+  return self.library.query(self.queries["count"])[0][0]
  
  def __contains__(self, item):
   item = to_unicode(item)
@@ -220,10 +351,10 @@ class Artists(object):
  def __getitem__(self, item):
   if isinstance(item, basestring):
    item = to_unicode(item)
-   r = self.library.query(self.queries["song_ids_from_artist"], artist=item)
+   r = self.library.query(self.queries["songs_from_artist"], artist=item)
    if not len(r):
     raise IndexError("no artist named '%s'" % item)
-   songs = tuple([Song(self.library, i[0]) for i in r if i])
+   songs = tuple(self.library.songs._parse_songs(r))
    return self.Artist(name=item, library=self.library, songs=songs)
   elif isinstance(item, (int, long)):
    return self[self.names[item]]
@@ -233,8 +364,11 @@ class Artists(object):
    raise TypeError("item must be a string, integer, or slice")
  
  def __iter__(self):
-  for i in self.names:
-   yield self[i]
+  q = self.queries["all_songs_by_artist"]
+  for name, rows in itertools.groupby(self.library.iter_query(q),
+                                      lambda i: i[4]):
+   songs = tuple(Song._from_row(self.library, i) for i in rows)
+   yield self.Artist(name=name, library=self.library, songs=songs)
  
  @property
  def names(self):
@@ -255,6 +389,23 @@ class Playlist(UserDict.DictMixin, object):
                                         WHERE playlist = :id""",
   "id_from_id": """SELECT id FROM playlists WHERE id = (:id)""",
   "id_from_name": """SELECT id FROM playlists WHERE name = (:name)""",
+  "import_add": """INSERT INTO playlist_import (position, relpath)
+                   VALUES (:position, :relpath)""",
+  "import_clear": """DELETE FROM playlist_import""",
+  "import_entries": """INSERT INTO playlist_entries (song, playlist)
+                       SELECT songs.id, :playlist FROM playlist_import
+                        INNER JOIN songs USING (relpath)
+                       WHERE songs.id NOT IN
+                        (SELECT song FROM playlist_entries
+                         WHERE playlist = :playlist)
+                       GROUP BY songs.id ORDER BY MIN(position)""",
+  "import_missing": """SELECT position, relpath FROM playlist_import
+                       WHERE relpath NOT IN (SELECT relpath FROM songs)
+                       ORDER BY position""",
+  "import_relpaths": """SELECT relpath FROM playlist_import
+                        ORDER BY position""",
+  "import_update": """UPDATE playlist_import SET relpath = :relpath
+                      WHERE position = :position""",
   "name_from_id": """SELECT name FROM playlists WHERE id = (:id)""",
   "name_from_name": """SELECT name FROM playlists WHERE name = (:name)""",
   "playlist_from_id": """SELECT id, name FROM playlists WHERE id = (:id)""",
@@ -321,7 +472,8 @@ class Playlist(UserDict.DictMixin, object):
    id_ = c.fetchall()[0][0]
   except IndexError:
    c.execute(cls.queries["add"], dict(name=name))
-   conn.commit()
+   library._increment_generation()
+   library._commit(conn)
    c.execute(cls.queries["id_from_name"], dict(name=name))
    try:
     id_ = c.fetchall()[0][0]
@@ -330,16 +482,11 @@ class Playlist(UserDict.DictMixin, object):
                      % name)
   if os.path.exists(path):
    songs = PlaylistFormat(library).load(path, True)
-   for song_path in songs:
-    song_relpath = library.relpath(song_path, library.music_path)
-    c.execute(Song.queries["id_from_relpath"], dict(relpath=song_relpath))
-    song_id = (c.fetchall() or [[None]])[0][0]
-    if not song_id or not quick:
-     song_id=Song._add(conn, c, library, song_path, quick=True, return_id=True)
-    c.execute(cls.queries["entry_id"], dict(song=song_id, playlist=id_))
-    if not len(c.fetchall()):
-     c.execute(cls.queries["entry_add"], dict(song=song_id, playlist=id_))
-    conn.commit()
+   try:
+    cls._import(conn, c, library, id_, songs, quick)
+   except ElementTree.ParseError as exc:
+    # The file is read as it is imported, so errors surface here
+    raise ValueError(u"%s could not be read: %s" % (path, exc))
   if not quick or return_id:
    if not quick and return_id:
     return id_
@@ -347,6 +494,41 @@ class Playlist(UserDict.DictMixin, object):
    ret.save()
    return ret
  
+ @classmethod
+ def _import(cls, conn, c, library, id_, song_paths, quick=False):
+  # Adds the songs at the given absolute paths (any iterable) to the playlist
+  # with the given ID.  The paths are resolved to songs with a single join
+  # against a temporary table; only paths that are not found that way are
+  # resolved again by following symlinks, and only songs that are still not
+  # in the database (or all of them if quick is False) are added to it.
+  c.execute(cls.queries["import_clear"])
+  # song_paths may be an iterator over a playlist file, which is read as the
+  # rows are inserted
+  c.executemany(cls.queries["import_add"],
+                (dict(position=n, relpath=i) for n, i in
+                 enumerate(library._iter_music_relpaths(song_paths))))
+  c.execute(cls.queries["import_missing"])
+  for position, relpath in c.fetchall():
+   real_relpath = library.relpath(os.path.join(library.music_path, relpath),
+                                  library.music_path)
+   if real_relpath != relpath:
+    c.execute(cls.queries["import_update"],
+              dict(position=position, relpath=real_relpath))
+  if quick:
+   c.execute(cls.queries["import_missing"])
+  else:
+   c.execute(cls.queries["import_relpaths"])
+  for relpath in [i[-1] for i in c.fetchall()]:
+   try:
+    Song._add(conn, c, library, relpath, quick=True)
+   except ValueError:
+    # The playlist refers to a file that is missing or not a song
+    pass
+  c.execute(cls.queries["import_entries"], dict(playlist=id_))
+  if c.rowcount > 0:
+   library._increment_generation()
+  library._commit(conn)
+ 
  @property
  def id(self): return self["id"]
  @property
@@ -406,8 +588,10 @@ class Playlist(UserDict.DictMixin, object):
  
  def add_song(self, song):
   if not self.has_song(song):
-   self.library.query(self.queries["entry_add"], song=song.id,
-                      playlist=self.id)
+   with self.library.bulk():
+    self.library.query(self.queries["entry_add"], song=song.id,
+                       playlist=self.id)
+    self.library._increment_generation()
    self.save()
  
  def __get_id(self):
@@ -429,15 +613,20 @@ class Playlist(UserDict.DictMixin, object):
   if not self.exists:
    raise Exception("the playlist '%s' is not in the database" % self.name)
   name = self.name
-  self.library.query(self.queries["delete_playlist_from_id"], id=self.id)
-  self.library.query(self.queries["delete_playlist_entries_from_id"],id=self.id)
+  with self.library.bulk():
+   self.library.query(self.queries["delete_playlist_from_id"], id=self.id)
+   self.library.query(self.queries["delete_playlist_entries_from_id"],
+                      id=self.id)
+   self.library._increment_generation()
   for path in self.paths.values():
    if os.path.isfile(os.path.realpath(path)): os.unlink(path)
  
  def remove_song(self, song):
   if self.has_song(song):
-   self.library.query(self.queries["entry_delete"], song=song.id,
-                      playlist=self.id)
+   with self.library.bulk():
+    self.library.query(self.queries["entry_delete"], song=song.id,
+                       playlist=self.id)
+    self.library._increment_generation()
    self.save()
  
  def rename(self, new_name):
@@ -448,31 +637,50 @@ class Playlist(UserDict.DictMixin, object):
    raise ValueError("The playlist's file must be within the playlist root.")
   old_name = self.name
   old_paths = self.paths
-  self.library.query(self.queries["rename_from_id"], name=new_name, id=self.id)
+  with self.library.bulk():
+   self.library.query(self.queries["rename_from_id"], name=new_name,
+                      id=self.id)
+   self.library._increment_generation()
   self.__data["name"] = to_unicode(new_name)
   new_paths = self.paths
   for dirname in self.library.playlist_formats:
    shutil.move(old_paths[dirname], new_paths[dirname])
  
  def save(self):
-  """Writes this playlist to disk."""
+  """Writes this playlist to disk.
+  
+  Only the files whose contents changed are written, so that they are not
+  needlessly rewritten (and re-synced by programs that watch them), and they
+  are replaced atomically (see atomic_write).  Inside
+  a Library.bulk block, the playlist is saved when the outermost block exits
+  instead, no matter how many times this is called.
+  
+  """
+  local = self.library._local
+  if getattr(local, "bulk", 0):
+   local.unsaved_playlists.add(self.name)
+   return
   for f in self.library.playlist_formats.values():
    plsf = f.format(self)
    if f.mp3_only:
     path_attr = "path_mp3" if f.absolute_paths else "relpath_mp3"
    else:
     path_attr = "path" if f.absolute_paths else "relpath"
-   plsf.save(f.path(self.name), title_fmt=f.title_format, path_attr=path_attr)
-   if f.substitutions:
-    with open(f.path(self.name), "rb") as fp:
-     data = fp.read().decode("utf8")
-    for search, replace, is_regex in f.substitutions:
-     if is_regex:
-      data = search.sub(replace, data)
-     else:
-      data = data.replace(search, replace)
-    with open(f.path(self.name), "wb") as fp:
-     fp.write(data.encode("utf8"))
+   data = plsf.render(title_fmt=f.title_format, path_attr=path_attr)
+   for search, replace, is_regex in f.substitutions or []:
+    if is_regex:
+     data = search.sub(replace, data)
+    else:
+     data = data.replace(search, replace)
+   data = data.encode("utf8")
+   path = f.path(self.name)
+   try:
+    with open(path, "rb") as fp:
+     if fp.read() == data:
+      continue
+   except EnvironmentError:
+    pass
+   atomic_write(path, data)
 
 
 class Playlists(object):
@@ -487,16 +695,21 @@ class Playlists(object):
   """
  queries = {
   "all_ids": """SELECT id FROM playlists ORDER BY name""",
-  "all_ids_quick": """SELECT id FROM playlists""",
-  "all_ids_sort_id": """SELECT id FROM playlists ORDER BY id""",
-  "all_playlists": """SELECT id, name FROM playlists ORDER BY name"""
+  "all_playlists": """SELECT id, name FROM playlists ORDER BY name""",
+  "count": """SELECT COUNT(*) FROM playlists""",
+  "greatest_id": """SELECT MAX(id) FROM playlists""",
+  "playlists_after_id": """SELECT id, name FROM playlists WHERE id > :after_id
+                           ORDER BY id LIMIT :limit""",
+  "playlists_from_id_range": """SELECT id, name FROM playlists
+                                WHERE id BETWEEN :low AND :high
+                                ORDER BY id"""
  }
  
  def __init__(self, library):
   self.library = library
  
  def __len__(self):
-  return len(self.library.query(self.queries["all_ids_quick"]))
+  return self.library.query(self.queries["count"])[0][0]
  
  def __contains__(self, pls):
   if isinstance(pls, Playlist):
@@ -517,13 +730,14 @@ class Playlists(object):
   if not isinstance(item, (basestring, int, long, slice, Playlist)):
    raise TypeError("item must be a string, integer, slice, or Playlist")
   if isinstance(item, slice):
-   r = []
-   for i in xrange(*item.indices((self.greatest_id() or 0) + 1)):
-    try:
-     r.append(Playlist(self.library, i))
-    except:
-     pass
-   return r
+   start, stop, step = item.indices((self.greatest_id() or 0) + 1)
+   ids = xrange(start, stop, step)
+   if not len(ids):
+    return []
+   q = self.queries["playlists_from_id_range"]
+   r = self.library.query(q, low=min(ids[0], ids[-1]),
+                          high=max(ids[0], ids[-1]))
+   return self._parse(filter_id_slice(r, start, step))
   if isinstance(item, Playlist): item = playlist.name
   return Playlist(self.library, item)
  
@@ -534,8 +748,8 @@ class Playlists(object):
  
  def _parse(self, result):
   # Makes a list of Playlist objects from a SQL query result (output of
-  # sqlite3.Cursor.fetchall)
-  return [Playlist(self.library, *i) for i in result]
+  # sqlite3.Cursor.fetchall) whose last column is the playlist name
+  return [Playlist(self.library, i[-1]) for i in result]
  
  def _update_playlists(self, playlists):
   for pls in playlists:
@@ -552,22 +766,45 @@ class Playlists(object):
   return self._parse(self.library.query(q))
  
  def greatest_id(self):
-  ids = [i[0] for i in self.library.query(self.queries["all_ids_sort_id"])
-         if i]
-  try:
-   return ids[-1]
-  except IndexError:
-   return None
+  return self.library.query(self.queries["greatest_id"])[0][0]
+ 
+ def page(self, after_id=None, limit=None):
+  """Returns the playlists with IDs greater than after_id, in ID order.
+  
+  At most limit playlists are returned.  To get the next page, pass the ID of
+  the last playlist returned as after_id.
+  
+  """
+  q = self.queries["playlists_after_id"]
+  return self._parse(self.library.query(q, after_id=after_id or 0,
+                                        limit=-1 if limit == None else limit))
  
- def scan(self):
+ def scan(self, save=True):
+  """Imports the playlist files in the default playlist folder.
+  
+  Then, if save is True, every playlist is saved in all of the playlist
+  formats, except the playlists whose files are malformed.
+  
+  """
   conn, c = self.library._setup_db()
-  for i in os.listdir(self.library.playlists_path):
-   name = custom_splitext(i, self.library.playlist_formats.default.ext)[0]
-   if name not in self.library.db_ignore_playlists:
-    Playlist._add(conn, c, self.library, name, True)
-  conn.commit()
+  # Playlists whose files are malformed are left alone
+  skipped = set()
+  with self.library.bulk():
+   for i in os.listdir(self.library.playlists_path):
+    name, ext = custom_splitext(i, self.library.playlist_formats.default.ext)
+    # Other files include the temporary files made by atomic_write
+    if ext and name not in self.library.db_ignore_playlists:
+     try:
+      Playlist._add(conn, c, self.library, name, True)
+     except ValueError as exc:
+      sys.stderr.write((u"warning: skipping playlist %s: %s\n"
+                        % (name, exc)).encode("utf8"))
+      skipped.add(name)
   c.close()
-  self.save()
+  for pls in self if save else []:
+   if pls.name not in self.library.db_ignore_playlists and \
+      pls.name not in skipped:
+    pls.save()
  
  def save(self):
   """Saves all playlists to disk."""
@@ -579,6 +816,8 @@ class Playlists(object):
 class PlaylistFormat(object):
  extensions = []
  name = None
+ # Compiled title formats, shared by all playlists
+ _templates = {}
  
  def __init__(self, library_or_playlist):
   if isinstance(library_or_playlist, Library):
@@ -591,115 +830,136 @@ class PlaylistFormat(object):
    raise TypeError("library_or_playlist must be a Library or Playlist")
  @classmethod
  def detect(self, filename):
-  ext = "." + filename.rsplit(".", 1)[1].lower()
+  ext = os.path.splitext(filename)[1].lower()
   if ext in M3UPlaylist.extensions:
-   with open(filename, "rb") as f:
-    try:
-     if f.next() == "#EXTM3U":
-      return ExtendedM3UPlaylist
-    except StopIteration:
-     pass
-    return M3UPlaylist
+   for line in self._iter_lines(filename):
+    if line.strip() == "#EXTM3U":
+     return ExtendedM3UPlaylist
+    break
+   return M3UPlaylist
   if ext in PLSPlaylist.extensions:
    return PLSPlaylist
+  if ext in XSPFPlaylist.extensions:
+   return XSPFPlaylist
   return None
+ @staticmethod
+ def _iter_lines(filename):
+  # Yields the lines of a text playlist file without their line endings.
+  # The file is decoded as UTF-8, with or without a byte order mark, and
+  # undecodable bytes are replaced instead of stopping the import.
+  with io.open(filename, "r", encoding="utf-8-sig", errors="replace",
+               newline=None) as f:
+   for line in f:
+    yield line.rstrip(u"\n")
+ def _iter_entries(self, filename):
+  # Yields the song paths in a playlist file as they are written in it.
+  # Subclasses must implement this method.
+  raise NotImplementedError()
  def format_title_string(self, song, fmt):
+  template = self._templates.get(fmt)
+  if template == None:
+   template = self._templates[fmt] = string.Template(fmt)
   d = collections.defaultdict(lambda: "", song)
   if not d["title"]:
    d["title"] = os.path.basename(song.relpath.rsplit(".", 1)[0])[0]
-  title = string.Template(fmt).substitute(d)
+  title = template.substitute(d)
   return title
+ def iter_paths(self, filename):
+  """Yields the absolute paths of the songs in a playlist file, in order.
+  
+  The file is read as the paths are yielded, so large playlists are never
+  held in memory all at once.  Paths outside of the music folder are
+  skipped.
+  
+  """
+  for p in self._iter_entries(filename):
+   try:
+    p = self.library.abspath(p, self.library.music_path)
+   except ValueError:
+    continue
+   if p:
+    yield p
  def load(self, filename, quick=False):
-  # Subclasses should not inherit this method's behavior
-  if type(self) != PlaylistFormat:
-   raise NotImplementedError()
-  fmt = self.detect(filename)
-  if not fmt:
-   raise ValueError(to_unicode(filename) + " is not in a supported format")
-  fmt = fmt(self.library)
-  load_result = fmt.load(filename, quick)
-  return load_result if quick else fmt
- def save(self, filename=None, title_fmt="$title", path_attr="path"):
-  raise NotImplementedError()
-
-class M3UPlaylist(PlaylistFormat):
- extensions = (".m3u", ".m3u8")
- name = "m3u"
- 
- def load(self, filename, quick=False):
-  with open(filename, "rb") as f:
-   paths = []
-   for p in f.read().decode("utf8").splitlines():
-    if p and not p.startswith("#"):
-     try:
-      p = self.library.abspath(p, self.library.music_path)
-     except ValueError:
-      continue
-     if not p:
-      continue
-     paths.append(p)
-   if quick:
-    return paths
+  """Loads a playlist file.
+  
+  If this is a PlaylistFormat, the file's format is detected and the
+  matching subclass loads it.  If quick is True, an iterator over the
+  absolute paths in the file is returned (see iter_paths).  Otherwise, songs
+  is set to the songs in the file that are in the database, and the object
+  that loaded the file is returned.
+  
+  """
+  if type(self) == PlaylistFormat:
+   fmt = self.detect(filename)
+   if not fmt:
+    raise ValueError(to_unicode(filename) + " is not in a supported format")
+   return fmt(self.library).load(filename, quick)
+  paths = self.iter_paths(filename)
+  if quick:
+   return paths
   self.songs = []
   for p in paths:
    p = self.library.relpath(p, self.library.music_path, False)
    if p in self.library.songs:
     self.songs.append(self.library.songs[p])
- 
- def save(self, filename=None, title_fmt="unused", path_attr="path"):
-  out = "\n".join([getattr(i, path_attr) for i in self.songs])
+  return self
+ def render(self, title_fmt="$title", path_attr="path"):
+  """Returns the playlist file's contents as a unicode string.
+  
+  Subclasses must implement this method.
+  
+  """
+  raise NotImplementedError()
+ def save(self, filename=None, title_fmt="$title", path_attr="path"):
+  """Writes the playlist to filename atomically, or returns its contents if
+  filename is None.
+  
+  """
+  out = self.render(title_fmt, path_attr)
   if filename:
-   with open(filename, "wb") as f:
-    f.write(out.encode("utf8"))
+   atomic_write(filename, out.encode("utf8"))
   else:
    return out
 
+class M3UPlaylist(PlaylistFormat):
+ extensions = (".m3u", ".m3u8")
+ name = "m3u"
+ 
+ def _iter_entries(self, filename):
+  # Extended M3U directives are comments to plain M3U
+  for line in self._iter_lines(filename):
+   if line and not line.startswith("#"):
+    yield line
+ 
+ def render(self, title_fmt="unused", path_attr="path"):
+  return "\n".join([getattr(i, path_attr) for i in self.songs])
+
 class ExtendedM3UPlaylist(M3UPlaylist):
  name = "extm3u"
  
- def save(self, filename=None, title_fmt="$title", path_attr="path"):
+ def render(self, title_fmt="$title", path_attr="path"):
   out = ["#EXTM3U", ""]
   for i in self.songs:
    title = self.format_title_string(i, title_fmt)
    length = int(round(i.length)) if i.length != None else -1
    path = getattr(i, path_attr)
    out += ["#EXTINF:%d,%s" % (length, title), path, ""]
-  out = "\n".join(out)
-  if filename:
-   with open(filename, "wb") as f:
-    f.write(out.encode("utf8"))
-  else:
-   return out
+  return "\n".join(out)
 
 class PLSPlaylist(PlaylistFormat):
  extensions = (".pls",)
  name = "pls"
  
- def load(self, filename):
-  cp = configparser.SafeConfigParser()
-  with open(filename, "rb") as f:
-   cp.readfp(f)
-  paths = []
-  length = int(cp.get("playlist", "NumberOfEntries"))
-  for i in range(1, length + 1):
-   if p:
-    p = cp.get("playlist", "File" + str(i))
-    try:
-     p = self.library.abspath(i, self.library.music_path)
-    except ValueError:
-     continue
-    if not p:
-     continue
-    paths.append(p)
-  self.songs = []
-  if quick:
-   return paths
-  for p in paths:
-   p = self.library.relpath(p, self.library.music_path, False)
-   if p in self.library.songs:
-    self.songs.append(self.library.songs[p])
+ def _iter_entries(self, filename):
+  # The FileN entries are yielded in the order they appear in the file, which
+  # is also the order of N in files written by render() and other players,
+  # so that they do not all have to be read first to be sorted
+  for line in self._iter_lines(filename):
+   key, sep, value = line.partition("=")
+   if sep and PLS_FILE_KEY_RE.match(key.strip()) and value.strip():
+    yield value.strip()
  
- def save(self, filename=None, title_fmt="$title", path_attr="path"):
+ def render(self, title_fmt="$title", path_attr="path"):
   out = ["[playlist]", ""]
   n = 1
   for i in self.songs:
@@ -709,33 +969,93 @@ class PLSPlaylist(PlaylistFormat):
            "Length%d=%d" % (n, length), ""]
    n = int(n) + 1
   out += ["NumberOfEntries="+str(int(n)-1), "", "Version=2", ""]
-  out = "\n".join(out)
-  if filename:
-   with open(filename, "wb") as f:
-    f.write(out.encode("utf8"))
-  else:
-   return out
+  return "\n".join(out)
+
+class XSPFPlaylist(PlaylistFormat):
+ extensions = (".xspf",)
+ name = "xspf"
+ namespace = "http://xspf.org/ns/0/"
+ 
+ def _iter_entries(self, filename):
+  # Each track is cleared and removed from its parent once its location has
+  # been read, so only one is in memory at a time.  Only file: URLs and
+  # relative URLs are paths; other locations (e.g. the Web app's http: URLs)
+  # are skipped.
+  track = "{%s}track" % self.namespace
+  location = "{%s}location" % self.namespace
+  # The elements that the parser is inside of
+  parents = []
+  for event, elem in ElementTree.iterparse(filename, ("start", "end")):
+   if event == "start":
+    parents.append(elem)
+    continue
+   parents.pop()
+   if elem.tag != track:
+    continue
+   for url in elem.findall(location):
+    url = (url.text or "").strip()
+    if url.startswith("file://"):
+     url = url[len("file://"):]
+     # Skip the host name, if any
+     url = url[url.find("/"):] if "/" in url else ""
+    elif re.match(r"^[a-zA-Z][a-zA-Z0-9+.-]*:", url):
+     continue
+    if url:
+     yield to_unicode(urllib.unquote(url.encode("utf8")), "utf8")
+     break
+   elem.clear()
+   if parents:
+    parents[-1].remove(elem)
+ 
+ def render(self, title_fmt="$title", path_attr="path"):
+  escape = xml.sax.saxutils.escape
+  out = ['<?xml version="1.0" encoding="UTF-8"?>',
+         '<playlist version="1" xmlns="%s">' % self.namespace,
+         ' <trackList>']
+  for i in self.songs:
+   path = getattr(i, path_attr)
+   url = to_unicode(urllib.quote(path.encode("utf8")))
+   if os.path.isabs(path):
+    url = "file://" + url
+   out += ["  <track>", "   <location>%s</location>" % escape(url),
+           "   <title>%s</title>" % escape(self.format_title_string(
+            i, title_fmt
+           ))]
+   if i.length != None:
+    out += ["   <duration>%d</duration>" % int(round(i.length * 1000))]
+   out += ["  </track>"]
+  out += [" </trackList>", "</playlist>", ""]
+  return "\n".join(out)
 
 playlist_file_formats = dict(
  m3u=M3UPlaylist,
  extm3u=ExtendedM3UPlaylist,
- pls=PLSPlaylist
+ pls=PLSPlaylist,
+ xspf=XSPFPlaylist
 )
 
 
-class Song(UserDict.DictMixin, object):
+class Song(object):
+ """A song in the library, which can also be used as a read-only mapping of
+its field names to values.
+
+"""
  queries = {
   "add": """INSERT INTO songs
              (relpath,title,sort_title,artist,sort_artist,album,sort_album,
-              length,disc_number,track_number)
+              length,disc_number,track_number,mtime,size,inode,content_hash)
             VALUES
              (:relpath,:title,:sort_title,:artist,:sort_artist,:album,
-              :sort_album,:length,:disc_number,:track_number)""",
+              :sort_album,:length,:disc_number,:track_number,:mtime,:size,
+              :inode,:content_hash)""",
   "delete_playlist_entries_from_id": """DELETE FROM playlist_entries
                                         WHERE song = :id""",
   "delete_song_from_id": """DELETE FROM songs WHERE id = :id""",
   "id_from_id": """SELECT id FROM songs WHERE id = (:id)""",
   "id_from_relpath": """SELECT id FROM songs WHERE relpath = (:relpath)""",
+  "ids_and_relpaths_from_content_hash": """SELECT id, relpath FROM songs
+                                           WHERE content_hash = :content_hash
+                                           ORDER BY id""",
   "playlists_from_id": """SELECT name FROM playlists
                           INNER JOIN playlist_entries ON
                            playlist_entries.playlist = playlists.id AND
@@ -760,11 +1080,24 @@ class Song(UserDict.DictMixin, object):
                              artist=:artist,sort_artist=:sort_artist,
                              album=:album,sort_album=:sort_album,length=:length,
                              disc_number=:disc_number,
-                             track_number=:track_number
+                             track_number=:track_number,mtime=:mtime,
+                             size=:size,inode=:inode,content_hash=:content_hash
                             WHERE relpath = :relpath""",
+  "update_file_from_id": """UPDATE songs SET
+                            relpath=:relpath,mtime=:mtime,size=:size,
+                            inode=:inode,content_hash=:content_hash
+                           WHERE id = :id""",
   "update_relpath_from_id": """UPDATE songs SET relpath=:relpath
                                WHERE id = :id"""
  }
+ # Fields in the order that song queries select them
+ fields = ("id", "relpath", "title", "sort_title", "artist", "sort_artist",
+           "album", "sort_album", "length", "disc_number", "track_number")
+ Record = collections.namedtuple("Record", fields)
+ _field_indexes = dict((name, i) for i, name in enumerate(fields))
+ # Songs are created for every row of every list, so they keep their values
+ # in a single Record instead of an instance dictionary.
+ __slots__ = ("library", "__record")
  
  def __init__(self, library, *info):
   """Returns a Song object with the given info.
@@ -798,44 +1131,81 @@ class Song(UserDict.DictMixin, object):
      raise ValueError("'%s' is not a valid music file" % search)
     info = [None] + info
   self.library = library
-  self.__data = {
-   "relpath": to_unicode(info[1]),
-   "title": to_unicode(info[2]),
-   "sort_title": to_unicode(info[3]),
-   "artist": to_unicode(info[4]),
-   "sort_artist": to_unicode(info[5]),
-   "album": to_unicode(info[6]),
-   "sort_album": to_unicode(info[7]),
-   "length": to_unicode(info[8]),
-   "disc_number": to_unicode(info[9]),
-   "track_number": to_unicode(info[10])
-  }
   try:
-   self.__data["id"] = int(info[0])
+   id_ = int(info[0])
   except TypeError:
-   self.__data["id"] = self.__get_id()
+   id_ = None
+  self.__record = self.Record(id_, *[to_unicode(i) for i in info[1:]])
+  if id_ == None:
+   self.__record = self.__record._replace(id=self.__get_id())
+ 
+ def __cmp__(self, other):
+  if other == None:
+   return 1
+  if isinstance(other, Song):
+   other = dict(other.iteritems())
+  return cmp(dict(self.iteritems()), other)
+ 
+ def __contains__(self, key):
+  return key in self._field_indexes
  
  def __getitem__(self, key):
-  return self.__data[key]
+  return self.__record[self._field_indexes[key]]
+ 
+ def __iter__(self):
+  return iter(self.fields)
+ 
+ def __len__(self):
+  return len(self.fields)
+ 
+ def __repr__(self):
+  return repr(dict(self.iteritems()))
+ 
+ def get(self, key, default=None):
+  if key in self._field_indexes:
+   return self[key]
+  return default
+ 
+ def has_key(self, key):
+  return key in self._field_indexes
+ 
+ def items(self):
+  return zip(self.fields, self.__record)
+ 
+ def iteritems(self):
+  return itertools.izip(self.fields, self.__record)
+ 
+ def iterkeys(self):
+  return iter(self.fields)
+ 
+ def itervalues(self):
+  return iter(self.__record)
  
  def keys(self):
-  return self.__data.keys()
+  return list(self.fields)
+ 
+ def values(self):
+  return list(self.__record)
+ 
+ @classmethod
+ def _from_row(cls, library, row):
+  # Makes a Song from a database row containing the columns in
+  # Song.fields, skipping the checks and conversions done by __init__.
+  # SQLite already returns text as unicode and ids as integers.
+  song = cls.__new__(cls)
+  song.library = library
+  song.__record = cls.Record._make(row)
+  return song
  
  @classmethod
  def _add(cls, conn, c, library, relpath, quick=False, return_id=False):
   library.check_path(relpath, library.music_path)
   info = library._get_song_info(relpath)
   if info:
-   c.fetchall()
-   c.execute(cls.queries["id_from_relpath"], dict(relpath=relpath))
-   exists = len(c.fetchall())
-   qname = "update_from_relpath" if exists else "add"
-   c.execute(cls.queries[qname], dict(
-    relpath=info[0], title=info[1], sort_title=info[2], artist=info[3],
-    sort_artist=info[4], album=info[5], sort_album=info[6], length=info[7],
-    disc_number=info[8], track_number=info[9]
-   ))
-   conn.commit()
+   cls._save_info(c, info, library._get_fingerprint(relpath),
+                  library._get_content_hash(relpath))
+   library._increment_generation()
+   library._commit(conn)
    if not quick or return_id:
     c.fetchall()
     c.execute(cls.queries["id_from_relpath"], dict(relpath=relpath))
@@ -848,6 +1218,23 @@ class Song(UserDict.DictMixin, object):
      return id_
     return cls(library, *([id_] + info))
  
+ @classmethod
+ def _save_info(cls, c, info, fingerprint=None, content_hash=None):
+  # Adds or updates a song in the database using the output of
+  # Library._get_song_info, Library._get_fingerprint, and
+  # Library._get_content_hash.  Does not commit.
+  mtime, size, inode = fingerprint or (None, None, None)
+  c.fetchall()
+  c.execute(cls.queries["id_from_relpath"], dict(relpath=info[0]))
+  exists = len(c.fetchall())
+  qname = "update_from_relpath" if exists else "add"
+  c.execute(cls.queries[qname], dict(
+   relpath=info[0], title=info[1], sort_title=info[2], artist=info[3],
+   sort_artist=info[4], album=info[5], sort_album=info[6], length=info[7],
+   disc_number=info[8], track_number=info[9], mtime=mtime, size=size,
+   inode=inode, content_hash=content_hash
+  ))
+ 
  def _update_playlists(self, playlists=None):
   if playlists == None: playlists = self.playlists
   self.library.playlists._update_playlists(playlists)
@@ -857,34 +1244,36 @@ class Song(UserDict.DictMixin, object):
  @property
  def path_mp3(self): return self.path.rsplit(".", 1)[0] + ".mp3"
  @property
- def relpath(self): return self["relpath"]
+ def relpath(self): return self.__record.relpath
  @relpath.setter
  def relpath(self, new_relpath):
-  self.__data["relpath"] = new_relpath
-  self.library.query(self.queries["update_relpath_from_id"],
-                     relpath=new_relpath, id=self.id)
+  self.__record = self.__record._replace(relpath=new_relpath)
+  with self.library.bulk():
+   self.library.query(self.queries["update_relpath_from_id"],
+                      relpath=new_relpath, id=self.id)
+   self.library._increment_generation()
  @property
  def relpath_mp3(self): return self.relpath.rsplit(".", 1)[0] + ".mp3"
  @property
- def id(self): return self["id"]
+ def id(self): return self.__record.id
  @property
- def title(self): return self["title"]
+ def title(self): return self.__record.title
  @property
- def sort_title(self): return self["sort_title"]
+ def sort_title(self): return self.__record.sort_title
  @property
- def artist(self): return self["artist"]
+ def artist(self): return self.__record.artist
  @property
- def sort_artist(self): return self["sort_artist"]
+ def sort_artist(self): return self.__record.sort_artist
  @property
- def album(self): return self["album"]
+ def album(self): return self.__record.album
  @property
- def sort_album(self): return self["sort_album"]
+ def sort_album(self): return self.__record.sort_album
  @property
- def length(self): return self["length"]
+ def length(self): return self.__record.length
  @property
- def disc_number(self): return self["disc_number"]
+ def disc_number(self): return self.__record.disc_number
  @property
- def track_number(self): return self["track_number"]
+ def track_number(self): return self.__record.track_number
  
  @property
  def exists(self):
@@ -900,10 +1289,7 @@ class Song(UserDict.DictMixin, object):
  
  @property
  def tuple(self):
-  return (self["id"], (self["title"], self["sort_title"], self["artist"],
-                       self["sort_artist"], self["album"], self["sort_album"],
-                       self["length"], self["disc_number"],
-                       self["track_number"]))
+  return (self.__record.id, self.__record[2:])
  
  def __get_id(self):
   q = self.queries["id_from_relpath"]
@@ -914,26 +1300,18 @@ class Song(UserDict.DictMixin, object):
  
  def load_metadata(self):
   info = self.library._get_song_info(self.relpath)
-  self.__data.update({
-   "relpath": to_unicode(info[0]),
-   "title": to_unicode(info[1]),
-   "sort_title": to_unicode(info[2]),
-   "artist": to_unicode(info[3]),
-   "sort_artist": to_unicode(info[4]),
-   "album": to_unicode(info[5]),
-   "sort_album": to_unicode(info[6]),
-   "length": to_unicode(info[7]),
-   "disc_number": to_unicode(info[8]),
-   "track_number": to_unicode(info[9])
-  })
+  self.__record = self.Record(self.__record.id,
+                              *[to_unicode(i) for i in info])
  
  def remove(self):
   if not self.exists:
    raise Exception("the song at '%s' is not in the database" % self.relpath)
   playlists = self.playlists
-  self.library.query(self.queries["delete_song_from_id"], id=self.id)
-  self.library.query(self.queries["delete_playlist_entries_from_id"],
-                       id=self.id)
+  with self.library.bulk():
+   self.library.query(self.queries["delete_song_from_id"], id=self.id)
+   self.library.query(self.queries["delete_playlist_entries_from_id"],
+                      id=self.id)
+   self.library._increment_generation()
   self._update_playlists(playlists)
  
  def update(self):
@@ -943,7 +1321,14 @@ class Song(UserDict.DictMixin, object):
      not self.library.check_path(self.relpath, self.library.music_path, False):
    raise ValueError("The song file must be within the library root.")
   self.load_metadata()
-  self.library.query(self.queries["update_from_relpath"], **self)
+  mtime, size, inode = (self.library._get_fingerprint(self.relpath)
+                        or (None, None, None))
+  content_hash = self.library._get_content_hash(self.relpath)
+  with self.library.bulk():
+   self.library.query(self.queries["update_from_relpath"], **dict(
+    self, mtime=mtime, size=size, inode=inode, content_hash=content_hash
+   ))
+   self.library._increment_generation()
   self._update_playlists()
 
 
@@ -956,26 +1341,102 @@ unless you know what you're doing.
 """
  queries = {
   "all_ids": """SELECT id FROM songs ORDER BY sort_title""",
-  "all_ids_quick": """SELECT id FROM songs""",
-  "all_ids_sort_id": """SELECT id FROM songs ORDER BY id""",
+  "all_fingerprints": """SELECT relpath, mtime, size, inode FROM songs""",
   "all_songs": """SELECT
                    id,relpath,title,sort_title,artist,sort_artist,album,
                    sort_album,length,disc_number,track_number
                   FROM songs ORDER BY
                    sort_title, sort_artist, sort_album, length""",
-  "id_from_*": """SELECT id FROM songs WHERE %s = :value""",
-  "id_from_*_like": """SELECT id FROM songs WHERE %s LIKE :value""",
-  "id_from_*_sorted_by_*": """SELECT id FROM songs WHERE %s = :value
-                              ORDER BY %s""",
-  "id_from_*_sorted_by_*_like": """SELECT id FROM songs WHERE %s LIKE :value
-                                   ORDER BY %s"""
+  "count": """SELECT COUNT(*) FROM songs""",
+  "fingerprint_from_relpath": """SELECT relpath, mtime, size, inode FROM songs
+                                 WHERE relpath = :relpath""",
+  "greatest_id": """SELECT MAX(id) FROM songs""",
+  "fingerprints_from_range": """SELECT relpath, mtime, size, inode FROM songs
+                                WHERE relpath >= :low AND relpath < :high""",
+  "move_from_range": """UPDATE songs
+                        SET relpath =
+                         :prefix || substr(relpath, length(:low) + 1)
+                        WHERE relpath >= :low AND relpath < :high""",
+  "move_from_relpath": """UPDATE songs SET relpath = :dst
+                          WHERE relpath = :src""",
+  "playlists_from_range": """SELECT DISTINCT playlists.name FROM songs
+                             INNER JOIN playlist_entries ON
+                              playlist_entries.song = songs.id
+                             INNER JOIN playlists ON
+                              playlists.id = playlist_entries.playlist
+                             WHERE relpath >= :low AND relpath < :high""",
+  "playlists_from_relpath": """SELECT DISTINCT playlists.name FROM songs
+                               INNER JOIN playlist_entries ON
+                                playlist_entries.song = songs.id
+                               INNER JOIN playlists ON
+                                playlists.id = playlist_entries.playlist
+                               WHERE relpath = :relpath""",
+  "relpaths_without_content_hash": """SELECT relpath FROM songs
+                                      WHERE content_hash IS NULL
+                                      ORDER BY relpath""",
+  "songs_after_id": """SELECT
+                        id,relpath,title,sort_title,artist,sort_artist,album,
+                        sort_album,length,disc_number,track_number
+                       FROM songs WHERE id > :after_id
+                       ORDER BY id LIMIT :limit""",
+  "songs_from_id_range": """SELECT
+                             id,relpath,title,sort_title,artist,sort_artist,
+                             album,sort_album,length,disc_number,track_number
+                            FROM songs WHERE id BETWEEN :low AND :high
+                            ORDER BY id""",
+  "songs_from_*": """SELECT
+                      id,relpath,title,sort_title,artist,sort_artist,album,
+                      sort_album,length,disc_number,track_number
+                     FROM songs WHERE %s = :value
+                     ORDER BY %s LIMIT :limit""",
+  "songs_from_*_like": """SELECT
+                           id,relpath,title,sort_title,artist,sort_artist,
+                           album,sort_album,length,disc_number,track_number
+                          FROM songs WHERE %s LIKE :value ESCAPE '\\'
+                          ORDER BY %s LIMIT :limit""",
+  "songs_from_search": """SELECT
+                           songs.id,songs.relpath,songs.title,sort_title,
+                           songs.artist,sort_artist,songs.album,sort_album,
+                           length,disc_number,track_number
+                          FROM songs_search INNER JOIN songs ON
+                           songs.id = songs_search.rowid
+                          WHERE songs_search MATCH :match
+                          ORDER BY %s LIMIT :limit""",
+  "update_content_hash_from_relpath": """UPDATE songs
+                                         SET content_hash=:content_hash
+                                         WHERE relpath = :relpath"""
  }
+ # Fields that are in the full-text search index
+ search_fields = ("title", "artist", "album", "relpath")
+ ScanResult = collections.namedtuple("ScanResult",
+                                     "added updated moved removed unchanged")
+ ScanProgress = collections.namedtuple("ScanProgress",
+                                       "done total size started updated")
+ class ScanProgress(ScanProgress):
+  """The progress of a scan:  the number of files whose tags were read out of
+the total number that have to be read, their total size in bytes, and the
+times when the scan started and when this progress was recorded.
+
+"""
+  @property
+  def elapsed(self):
+   return self.updated - self.started
+  @property
+  def rate(self):
+   """The number of files read per second."""
+   return self.done / self.elapsed if self.elapsed > 0 else 0.0
+  @property
+  def eta(self):
+   """The estimated number of seconds left, or None if it is unknown."""
+   if not self.rate:
+    return None
+   return (self.total - self.done) / self.rate
  
  def __init__(self, library):
   self.library = library
  
  def __len__(self):
-  return len(self.library.query(self.queries["all_ids_quick"]))
+  return self.library.query(self.queries["count"])[0][0]
  
  def __contains__(self, song):
   if isinstance(song, Song):
@@ -996,38 +1457,51 @@ unless you know what you're doing.
   if not isinstance(item, (basestring, int, long, slice, Song)):
    raise TypeError("item must be a string, integer, slice, or Song")
   if isinstance(item, slice):
-   r = []
-   for i in xrange(*item.indices((self.greatest_id() or 0) + 1)):
-    try:
-     r.append(Song(self.library, i))
-    except:
-     pass
-   return r
+   start, stop, step = item.indices((self.greatest_id() or 0) + 1)
+   ids = xrange(start, stop, step)
+   if not len(ids):
+    return []
+   q = self.queries["songs_from_id_range"]
+   r = self.library.query(q, low=min(ids[0], ids[-1]),
+                          high=max(ids[0], ids[-1]))
+   return self._parse_songs(filter_id_slice(r, start, step))
   if isinstance(item, Song): item = item.relpath
   return Song(self.library, item)
  
  def __iter__(self):
-  ids = [i[0] for i in self.library.query(self.queries["all_ids"]) if i]
-  for i in ids:
-   try:
-    r = self.library.query(Song.queries["song_from_id"], id=i)[0]
-   except IndexError:
-    continue
-   yield Song(self.library, *r)
+  for i in self.library.iter_query(self.queries["all_songs"]):
+   yield Song._from_row(self.library, i)
  
  def _parse_songs(self, result):
   # Makes a list of Song objects from a SQL query result (output of
-  # sqlite3.Cursor.fetchall)
-  return [Song(self.library, *i) for i in result]
- 
- def _update_relpath(self, old_relpath, new_relpath):
-  # This is used by Library.move as the callback for our utility function
-  # mvdir.  It is called for all files moved, even non-songs.
-  try:
-   song = self[old_relpath]
-  except ValueError:
-   return
-  song.relpath = new_relpath
+  # sqlite3.Cursor.fetchall) whose columns are Song.fields
+  return [Song._from_row(self.library, i) for i in result]
+ 
+ def _move(self, src, dst, playlists=None):
+  # Changes the relpath of the song at src, or the relpaths of the songs in
+  # the folder at src, to the same relpath at dst, using one UPDATE for each
+  # instead of one for each song.  The names of the playlists that contain
+  # the songs are added to playlists (a set).  Returns the number of songs
+  # that were moved.
+  library = self.library
+  folder = _relpath_range(src)
+  prefix = "" if dst in ("", ".") else dst + "/"
+  conn, c = library._setup_db()
+  with library.bulk():
+   if playlists != None:
+    c.execute(self.queries["playlists_from_relpath"], dict(relpath=src))
+    playlists.update(i[0] for i in c.fetchall())
+    c.execute(self.queries["playlists_from_range"], folder)
+    playlists.update(i[0] for i in c.fetchall())
+   c.execute(self.queries["move_from_relpath"], dict(src=src, dst=dst))
+   moved = c.rowcount
+   c.execute(self.queries["move_from_range"], dict(folder, prefix=prefix))
+   moved += c.rowcount
+   if moved:
+    library._increment_generation()
+   library._commit(conn)
+  c.close()
+  return moved
  
  def add(self, relpath, quick=False, return_id=False):
   conn, c = self.library._setup_db()
@@ -1039,38 +1513,283 @@ unless you know what you're doing.
   return self._parse_songs(self.library.query(self.queries["all_songs"]))
  
  def greatest_id(self):
-  ids = [i[0] for i in self.library.query(self.queries["all_ids_sort_id"])
-         if i]
-  try:
-   return ids[-1]
-  except IndexError:
-   return None
+  return self.library.query(self.queries["greatest_id"])[0][0]
  
- def scan(self):
-  conn, c = self.library._setup_db()
+ def page(self, after_id=None, limit=None):
+  """Returns the songs with IDs greater than after_id, in ID order.
+  
+  At most limit songs are returned.  To get the next page, pass the ID of the
+  last song returned as after_id.
+  
+  """
+  q = self.queries["songs_after_id"]
+  return self._parse_songs(self.library.query(
+   q, after_id=after_id or 0, limit=-1 if limit == None else limit
+  ))
+ 
+ def scan(self, jobs=None, resume=False, progress=None, prune=False):
+  """Adds, updates, moves, or removes all songs in the music folder.
+  
+  Only new files and files whose modification time, size, or inode changed
+  since they were last scanned have their tags read.  If jobs is greater than
+  1, that many worker processes are used to read the tags, and this process
+  writes the results to the database.
+  
+  Songs whose files are missing are removed, unless a new file has the same
+  content hash (see Library._get_content_hash), in which case the song is
+  moved to the new file instead; moved songs keep their playlists and do not
+  have their tags read again.  If the music folder itself is missing, no songs
+  are moved or removed.  If more than SCAN_PRUNE_MAX_FRACTION of the songs
+  would be removed (e.g. because the music folder is an empty mountpoint),
+  none are removed and a warning is printed, unless prune is True.  Songs
+  that do not have a content hash yet (e.g. after upgrading the database)
+  have it read at the end of the scan.
+  
+  Files are read in order of their relpaths.  Every SCAN_CHECKPOINT_INTERVAL
+  files, the last relpath read and a ScanProgress are saved in the database
+  along with the songs (see Library.scan_progress).  If resume is True and
+  the previous scan was interrupted, the files up to its last checkpoint are
+  assumed to be unchanged and are not examined again.  progress, if given, is
+  called with a ScanProgress after each file is read.
+  
+  Returns a ScanResult with the number of songs that were added, updated,
+  moved, removed, or unchanged.
+  
+  The database is written to in large transactions using Library.bulk.  An
+  Exception is raised if the database is being rebuilt (see Library.rebuild).
+  
+  """
+  library = self.library
+  # Held until the scan returns
+  lock = library._lock_writers()
+  started = time.time()
+  checkpoint = library.get_meta("scan_checkpoint") if resume else None
+  q = self.queries["all_fingerprints"]
+  known = dict((i[0], tuple(i[1:])) for i in library.iter_query(q))
+  changed = {}
+  stats = dict(added=0, updated=0, moved=0, removed=0, unchanged=0)
+  # The whole folder has to be walked before any file can be recognized as
+  # a moved song
+  relpaths = list(self._find_changed_relpaths(known, changed, stats,
+                                              checkpoint))
+  if os.path.isdir(library.music_path):
+   self._move_or_remove(set(known), changed, stats, prune=prune)
+   relpaths = [i for i in relpaths if i in changed]
+  sizes = [(changed[i][0] or (None, 0))[1] for i in relpaths]
+  state = dict(done=0, size=0)
+  def saved(c):
+   # Called by _save_infos after each file, in the same order as relpaths
+   i = state["done"]
+   state["done"] += 1
+   state["size"] += sizes[i]
+   p = self.ScanProgress(done=state["done"], total=len(relpaths),
+                         size=state["size"], started=started,
+                         updated=time.time())
+   if p.done % SCAN_CHECKPOINT_INTERVAL == 0:
+    c.execute(library.queries["set_meta"],
+              dict(key="scan_checkpoint", value=relpaths[i]))
+    c.execute(library.queries["set_meta"],
+              dict(key="scan_progress", value=json.dumps(p)))
+   if callable(progress):
+    progress(p)
+  if jobs and jobs > 1:
+   pool = multiprocessing.Pool(jobs, _scan_worker_init,
+                               (library.config, _GPL))
+   try:
+    infos = pool.imap(_scan_worker, relpaths, SCAN_CHUNK_SIZE)
+    self._save_infos(infos, changed, stats, saved)
+   except:
+    pool.terminate()
+    raise
+   else:
+    pool.close()
+   finally:
+    pool.join()
+  else:
+   infos = itertools.imap(library._get_song_info_and_hash, relpaths)
+   self._save_infos(infos, changed, stats, saved)
+  self._save_content_hashes()
+  with library.bulk():
+   for key in ("scan_checkpoint", "scan_progress"):
+    library.query(library.queries["delete_meta"], key=key)
+  return self.ScanResult(**stats)
+ 
+ def _find_changed_relpaths(self, known, changed, stats, checkpoint=None):
+  # Yields the relative paths of all song files that are not in known (a dict
+  # of relpaths to fingerprints) with the same fingerprint, in sorted order.
+  # Every path found is removed from known, and the paths that are yielded
+  # are added to changed along with their fingerprint, whether they were in
+  # known, and their content hash (None until it is needed).  Files in known
+  # whose relpaths are not after checkpoint are assumed to be unchanged.
+  for relpath in sorted(self._find_relpaths()):
+   if checkpoint != None and relpath <= checkpoint and relpath in known:
+    del known[relpath]
+    stats["unchanged"] += 1
+    continue
+   fingerprint = self.library._get_fingerprint(relpath)
+   exists = relpath in known
+   if exists and fingerprint and known.pop(relpath) == fingerprint:
+    stats["unchanged"] += 1
+    continue
+   known.pop(relpath, None)
+   changed[relpath] = (fingerprint, exists, None)
+   yield relpath
+ 
+ def _find_relpaths(self):
+  # Yields the relative paths of all files in the music folder that have a
+  # supported extension, in sorted order.
   for root, dirs, files in os.walk(self.library.music_path, followlinks=True):
    dirs.sort()
    for i in sorted(files):
-    relpath = self.library.relpath(os.path.join(root,i),self.library.music_path)
-    Song._add(conn, c, self.library, relpath, True)
+    if get_format(os.path.splitext(i)[1]):
+     yield self.library.relpath(os.path.join(root, i),
+                                self.library.music_path)
+ 
+ def _move_or_remove(self, missing, changed, stats, playlists=None,
+                     prune=False):
+  # Moves or removes the songs in the database whose files are missing (a set
+  # of relpaths) in a bulk transaction.  A new file in changed (see
+  # _find_changed_relpaths) with the same content hash as a missing song is
+  # that song's new location, so only the song's relpath and fingerprint are
+  # updated, and the file is removed from changed so that its tags are not
+  # read.  The other missing songs are removed, unless they are more than
+  # SCAN_PRUNE_MAX_FRACTION of the songs and prune is False.  The names of
+  # the playlists that contain moved or removed songs are added to playlists
+  # (a set).
+  library = self.library
+  conn, c = library._setup_db()
+  with library.bulk():
+   for relpath in sorted(changed) if missing else []:
+    fingerprint, exists, content_hash = changed[relpath]
+    if exists:
+     continue
+    if content_hash == None:
+     content_hash = library._get_content_hash(relpath)
+     changed[relpath] = (fingerprint, exists, content_hash)
+    if content_hash == None:
+     continue
+    q = Song.queries["ids_and_relpaths_from_content_hash"]
+    c.execute(q, dict(content_hash=content_hash))
+    matches = [i for i in c.fetchall() if i[1] in missing]
+    if not matches:
+     continue
+    id_, old_relpath = matches[0]
+    if playlists != None:
+     c.execute(Song.queries["playlists_from_id"], dict(id=id_))
+     playlists.update(i[0] for i in c.fetchall())
+    mtime, size, inode = fingerprint or (None, None, None)
+    c.execute(Song.queries["update_file_from_id"], dict(
+     id=id_, relpath=relpath, mtime=mtime, size=size, inode=inode,
+     content_hash=content_hash
+    ))
+    missing.remove(old_relpath)
+    del changed[relpath]
+    stats["moved"] += 1
+    library._increment_generation()
+    library._commit(conn)
+   c.execute(self.queries["count"])
+   total = c.fetchone()[0]
+   if not prune and len(missing) > SCAN_PRUNE_MAX_FRACTION * total:
+    sys.stderr.write(("warning: not removing the %d of %d songs whose files"
+                      " are missing, since the music folder may not be"
+                      " mounted; scan with --prune to remove them\n"
+                      % (len(missing), total)))
+    missing = set()
+   for relpath in sorted(missing):
+    c.execute(Song.queries["id_from_relpath"], dict(relpath=relpath))
+    for id_, in c.fetchall():
+     if playlists != None:
+      c.execute(Song.queries["playlists_from_id"], dict(id=id_))
+      playlists.update(i[0] for i in c.fetchall())
+     c.execute(Song.queries["delete_song_from_id"], dict(id=id_))
+     c.execute(Song.queries["delete_playlist_entries_from_id"], dict(id=id_))
+     stats["removed"] += 1
+     library._increment_generation()
+     library._commit(conn)
+  c.close()
+ 
+ def _save_content_hashes(self):
+  # Reads and stores the content hashes of the songs that do not have one,
+  # which migration 7 leaves empty so that upgrading does not read every song
+  # file, in a bulk transaction.
+  library = self.library
+  conn, c = library._setup_db()
+  c.execute(self.queries["relpaths_without_content_hash"])
+  relpaths = [i[0] for i in c.fetchall()]
+  with library.bulk():
+   for relpath in relpaths:
+    content_hash = library._get_content_hash(relpath)
+    if content_hash != None:
+     c.execute(self.queries["update_content_hash_from_relpath"],
+               dict(relpath=relpath, content_hash=content_hash))
+     library._commit(conn)
+  c.close()
+ 
+ def _save_infos(self, infos, changed, stats, callback=None):
+  # Writes the output of Library._get_song_info_and_hash for many songs to
+  # the database in a bulk transaction.  callback, if given, is called with
+  # the cursor after each item of infos (including empty ones) is written.
+  conn, c = self.library._setup_db()
+  with self.library.bulk():
+   for info, content_hash in infos:
+    if info:
+     fingerprint, exists, known_hash = changed.pop(info[0],
+                                                   (None, False, None))
+     Song._save_info(c, info, fingerprint, known_hash or content_hash)
+     stats["updated" if exists else "added"] += 1
+     self.library._increment_generation()
+    if callback:
+     callback(c)
+    self.library._commit(conn)
   c.close()
  
- def search(self, key, value, exact=True, sort="sort_title"):
-  qname = "id_from_*"
-  if sort:
-   if isinstance(sort, basestring):
-    sort = [sort]
-   if isinstance(sort, (list, tuple)):
-    sort = ",".join([re.sub(r"[^a-z_,]", "", i) for i in sort if i.strip()])
+ def search(self, key, value, exact=True, sort="sort_title", limit=None):
+  """Returns a list of the songs whose `key` field matches `value`.
+  
+  If exact is True, the field must be equal to value.  Otherwise, the field
+  must contain value.  key may be None to search all of the fields in
+  search_fields.
+  
+  When the full-text search index is available and key is None or one of
+  search_fields, inexact searches use the index instead, and they match
+  songs that contain words starting with each of the words in value.
+  
+  sort is a field name or a list of them; "rank" sorts by relevance when the
+  full-text search index is used.  At most limit songs are returned.
+  
+  """
+  value = to_unicode(value)
+  if key != None:
+   key = re.sub(r"[^a-z_]", "", key)
+  elif exact:
+   raise ValueError("key cannot be None when exact is True")
+  if isinstance(sort, basestring):
+   sort = [sort]
+  if not isinstance(sort, (list, tuple, types.NoneType)):
+   raise ValueError("sort must be a string, list, or tuple")
+  sort = [re.sub(r"[^a-z_]", "", i) for i in sort or [] if i.strip()]
+  words = re.findall(r"\w+", value, re.UNICODE)
+  params = dict(limit=limit if limit != None else -1)
+  if not exact and words and (key == None or key in self.search_fields) \
+     and self.library._has_search_index():
+   columns = key or "{%s}" % " ".join(self.search_fields)
+   params["match"] = " AND ".join([u'%s : "%s"*' % (columns, i)
+                                   for i in words])
+   sort = [("songs_search.rank" if i == "rank" else "songs." + i)
+           for i in sort]
+   q = self.queries["songs_from_search"] % (",".join(sort) or "songs.id")
+  else:
+   if key == None:
+    key = " || ' ' || ".join(self.search_fields)
+   qname = "songs_from_*"
+   if exact:
+    params["value"] = value
    else:
-    raise ValueError("sort must be a string, list, or tuple")
-   qname += "_sorted_by_*"
-  if not exact:
-   qname += "_like"
-   value = "%" + value.replace("_", "%_") + "%"
-  print repr(key), repr(sort)
-  q = self.queries[qname] % ((key, sort) if sort else key)
-  return [self[i[0]] for i in self.library.query(q, value=value) if i]
+    qname += "_like"
+    params["value"] = "%" + re.sub(r"([\\%_])", r"\\\1", value) + "%"
+   sort = [i for i in sort if i != "rank"]
+   q = self.queries[qname] % (key, ",".join(sort) or "id")
+  return self._parse_songs(self.library.query(q, **params))
  
  def to_mp3(self):
   library = self.library.music_path
@@ -1088,14 +1807,113 @@ unless you know what you're doing.
                    self.library.constant_bitrate, self.library.vbr_quality)
 
 
+def _scan_worker_init(config, gpl):
+ # Initializer for the worker processes used by Songs.scan
+ global _scan_library
+ if gpl:
+  enable_gpl()
+ _scan_library = Library(config)
+
+def _scan_worker(relpath):
+ return _scan_library._get_song_info_and_hash(relpath)
+
+_scan_library = None
+
+
 class Library(object):
+ """A Leviathan music library and its database.
+
+Concurrency:  the database is kept in SQLite's write-ahead logging (WAL)
+mode, so any number of processes (e.g. uWSGI workers running the Web app)
+can read from it while one process (e.g. `leviathan scan` or `to-mp3`)
+writes to it.  Readers see the database as of the last committed
+transaction and are never blocked by the writer; they should use
+`generation` or `snapshot()` to notice changes.  Only one process can write
+at a time; a second writer waits up to DB_BUSY_TIMEOUT seconds for the lock
+and then fails with "database is locked".  Long writes like scans commit
+every BULK_BATCH_SIZE rows (see `bulk()`), so readers see their progress.
+Each thread uses its own connection (see `_connect()`).  All processes must
+be on the same machine as the database, and they need write access to the
+directory containing it for the -wal and -shm files.
+
+"""
+ Migration = collections.namedtuple("Migration",
+                                    "version statements backfill")
+ # Steps for upgrading the database schema, in order.  Each one upgrades the
+ # database from the previous version to `version` by running `statements`
+ # and then the method named by `backfill` (if any) with the connection.
+ # They run while holding the database's write lock, so they must not read
+ # song files; new fields are left empty for the next scan to fill in.  The
+ # statements should match the changes made to the schema in _setup_db.
+ migrations = [
+  Migration(
+   version="3",
+   statements=["""ALTER TABLE "songs" ADD COLUMN "disc_number" numeric""",
+               """ALTER TABLE "songs" ADD COLUMN "track_number" numeric"""],
+   backfill=None
+  ),
+  Migration(
+   version="4",
+   statements=["""ALTER TABLE "songs" ADD COLUMN "mtime" numeric""",
+               """ALTER TABLE "songs" ADD COLUMN "size" integer""",
+               """ALTER TABLE "songs" ADD COLUMN "inode" integer"""],
+   backfill=None
+  ),
+  Migration(
+   version="5",
+   statements=["""CREATE INDEX "songs_album_artist" ON "songs" (
+                   "album", "artist", "disc_number", "track_number",
+                   "sort_title", "sort_artist", "sort_album", "length"
+                  )""",
+               """CREATE INDEX "songs_artist" ON "songs" (
+                   "artist", "sort_title", "sort_artist", "sort_album",
+                   "length"
+                  )""",
+               """CREATE INDEX "songs_artist_album" ON "songs" (
+                   "artist", "album", "sort_album", "sort_artist"
+                  )""",
+               """CREATE INDEX "songs_sort_title" ON "songs" (
+                   "sort_title", "sort_artist", "sort_album", "length"
+                  )""",
+               """CREATE INDEX "playlist_entries_playlist_song"
+                   ON "playlist_entries" ("playlist", "song")""",
+               'DROP INDEX "playlist_entries_playlist"'],
+   backfill=None
+  ),
+  Migration(
+   version="6",
+   statements=[],
+   backfill="_create_search_index"
+  ),
+  Migration(
+   version="7",
+   statements=["""ALTER TABLE "songs" ADD COLUMN "content_hash" text""",
+               """CREATE INDEX "songs_content_hash" ON "songs" (
+                   "content_hash"
+                  )"""],
+   backfill=None
+  )
+ ]
  queries = {
   "all_meta_keys_and_values": """SELECT key, value FROM leviathan_meta
                                  ORDER BY key""",
   "add_meta": """INSERT INTO leviathan_meta (key, value)
                  VALUES (:key, :value)""",
+  "add_generation": """INSERT OR IGNORE INTO leviathan_meta (key, value)
+                       VALUES ('generation', 0)""",
+  "data_version": """PRAGMA data_version""",
+  "delete_meta": """DELETE FROM leviathan_meta WHERE key = :key""",
+  "increment_generation": """UPDATE leviathan_meta
+                             SET value = CAST(value AS integer) + 1
+                             WHERE key = 'generation'""",
+  "meta_table_from_schema": """SELECT name FROM sqlite_master WHERE
+                                type = 'table' AND name = 'leviathan_meta'""",
   "meta_value_from_key": """SELECT value FROM leviathan_meta WHERE
                              key = :key""",
+  "search_index_from_schema": """SELECT name FROM sqlite_master WHERE
+                                  type = 'table' AND name = 'songs_search'""",
+  "set_meta": """INSERT OR REPLACE INTO leviathan_meta (key, value)
+                 VALUES (:key, :value)""",
   "update_meta": """UPDATE leviathan_meta SET value = :value WHERE
                      key = :key"""
  }
@@ -1113,15 +1931,17 @@ class Library(object):
   else:
    raise ValueError("config must be a string, file object, or dict, not a(n) "
                      + type(config).__name__)
+  self.config = config
   # Library settings
   self.music_path = os.path.normpath(to_unicode(config["music_path"]))
   self.database_path = os.path.normpath(to_unicode(config["database_path"]))
   self.albumart_filename = to_unicode(config["albumart_filename"])
-  # Check database version
-  if os.path.exists(os.path.realpath(self.database_path)):
-   if int(self.get_meta("db_version") or 0) < int(DB_VERSION):
-    raise Exception("the database schema version is old; please delete and"
-                    " recreate the database")
+  # Database connections (one per thread; see _connect)
+  self._local = threading.local()
+  self._connection_epoch = 0
+  # In-memory copy of the library shared by all threads (see snapshot)
+  self._snapshot = None
+  self._snapshot_lock = threading.Lock()
   # Playlist settings
   self.playlist_formats = PlaylistFormatSettings()
   playlist_formats = config["playlist_formats"]
@@ -1205,6 +2025,9 @@ class Library(object):
   self.artists = Artists(self)
   self.songs = Songs(self)
   self.playlists = Playlists(self)
+  # Upgrade the database schema if necessary
+  if os.path.exists(os.path.realpath(self.database_path)):
+   self._migrate()
  
  def _get_song_info(self, relpath):
   if _GPL:
@@ -1218,42 +2041,42 @@ class Library(object):
   fmt = get_format(ext)
   ret = None
   if fmt:
-   cwd = os.getcwdu()
-   os.chdir(self.music_path)
-   if not os.path.isfile(os.path.realpath(relpath)):
-    os.chdir(cwd)
+   # The working directory is never changed, so that this is thread-safe
+   path = os.path.join(self.music_path, relpath)
+   if not os.path.isfile(os.path.realpath(path)):
     raise ValueError("The specified song does not exist or is not a regular"
                      " file or a link to one.")
-   try:
-    mg = mutagen.File(relpath, easy=True)
-    if mg:
-     title = to_unicode(mg.get("title", title)[0]
-                        if mg.get("title", title)[0] != "" else title[0])
-     sort_title = self._get_sort_value(mg, relpath, "title", title)
-     artist = sort_artist = ""
-     for tag in ("artist", "performer", "albumartist"):
-      if tag in mg:
-       artist = to_unicode(mg.get(tag, [""])[0])
-       sort_artist = self._get_sort_value(mg, relpath, tag, artist)
-       break
-     album = to_unicode(mg.get("album", [""])[0])
-     sort_album = self._get_sort_value(mg, relpath, "album", album)
-     disc_number = DISC_TRACK_NUMBER_RE.sub("/", mg.get("discnumber", [""])[0])
-     disc_number = disc_number.split("/")[0]
-     disc_number = int(disc_number) if disc_number else None
-     track_number = DISC_TRACK_NUMBER_RE.sub("/", mg.get("tracknumber",[""])[0])
-     track_number = track_number.split("/")[0]
-     track_number = int(track_number) if track_number else None
-     try:
-      length = mg.info.length
-     except AttributeError:
-      length = None
-     ret = [to_unicode(relpath), title, sort_title, artist, sort_artist, album,
-            sort_album, length, disc_number, track_number]
-   finally:
-    os.chdir(cwd)
+   mg = mutagen.File(path, easy=True)
+   if mg:
+    title = to_unicode(mg.get("title", title)[0]
+                       if mg.get("title", title)[0] != "" else title[0])
+    sort_title = self._get_sort_value(mg, relpath, "title", title)
+    artist = sort_artist = ""
+    for tag in ("artist", "performer", "albumartist"):
+     if tag in mg:
+      artist = to_unicode(mg.get(tag, [""])[0])
+      sort_artist = self._get_sort_value(mg, relpath, tag, artist)
+      break
+    album = to_unicode(mg.get("album", [""])[0])
+    sort_album = self._get_sort_value(mg, relpath, "album", album)
+    disc_number = get_number_tag(mg, "discnumber")
+    track_number = get_number_tag(mg, "tracknumber")
+    try:
+     length = mg.info.length
+    except AttributeError:
+     length = None
+    ret = [to_unicode(relpath), title, sort_title, artist, sort_artist, album,
+           sort_album, length, disc_number, track_number]
   return ret
  
+ def _get_song_info_and_hash(self, relpath):
+  # Returns the output of _get_song_info and _get_content_hash for a song
+  # file, so that scan workers read both instead of leaving the hashes to the
+  # process that writes to the database.  The hash is None if the file is not
+  # a song.
+  info = self._get_song_info(relpath)
+  return info, self._get_content_hash(relpath) if info else None
+ 
  def _get_sort_value(self, mg, relpath, tag, default_value):
   def my_dirname(path):
    if os.path.isdir(os.path.realpath(os.path.join(self.music_path, path))):
@@ -1272,12 +2095,133 @@ class Library(object):
      return to_unicode(mg[tag + "sort"][0]).lower()
   return to_unicode(sort_value(default_value))
  
- def _setup_db(self):
-  new = False if os.path.exists(os.path.realpath(self.database_path)) else True
-  conn = sqlite3.connect(self.database_path)
-  c = conn.cursor()
-  if new:
-   schema = """\
+ def _create_search_index(self, conn):
+  # Creates the full-text search index used by Songs.search along with the
+  # triggers that keep it up to date, if SQLite supports FTS5.  Otherwise,
+  # Songs.search falls back to LIKE queries.
+  try:
+   conn.execute("""CREATE VIRTUAL TABLE "songs_search" USING fts5(
+                    "title", "artist", "album", "relpath",
+                    content="songs", content_rowid="id"
+                   )""")
+  except sqlite3.OperationalError:
+   return
+  for statement in (
+   """CREATE TRIGGER "songs_search_insert" AFTER INSERT ON "songs" BEGIN
+       INSERT INTO songs_search (rowid, title, artist, album, relpath)
+        VALUES (new.id, new.title, new.artist, new.album, new.relpath);
+      END""",
+   """CREATE TRIGGER "songs_search_delete" AFTER DELETE ON "songs" BEGIN
+       INSERT INTO songs_search
+        (songs_search, rowid, title, artist, album, relpath)
+        VALUES ('delete', old.id, old.title, old.artist, old.album,
+                old.relpath);
+      END""",
+   """CREATE TRIGGER "songs_search_update"
+       AFTER UPDATE OF title, artist, album, relpath ON "songs" BEGIN
+       INSERT INTO songs_search
+        (songs_search, rowid, title, artist, album, relpath)
+        VALUES ('delete', old.id, old.title, old.artist, old.album,
+                old.relpath);
+       INSERT INTO songs_search (rowid, title, artist, album, relpath)
+        VALUES (new.id, new.title, new.artist, new.album, new.relpath);
+      END""",
+   """INSERT INTO songs_search (songs_search) VALUES ('rebuild')"""
+  ):
+   conn.execute(statement)
+ 
+ def _commit(self, conn):
+  # Commits conn, unless this thread is inside a bulk() block and fewer than
+  # BULK_BATCH_SIZE rows have been changed since the last commit.  If the
+  # library's contents changed, the generation is incremented in the same
+  # transaction, so that batches committed by a bulk() block that later fails
+  # or is interrupted are still seen by snapshots.
+  local = self._local
+  if getattr(local, "bulk", 0) and \
+     conn.total_changes - local.bulk_changes < BULK_BATCH_SIZE:
+   return
+  if getattr(local, "generation_changed", False):
+   # The generation starts at 0 and is created on first use
+   conn.execute(self.queries["add_generation"])
+   conn.execute(self.queries["increment_generation"])
+   local.generation_changed = False
+   local.data_version = None
+  conn.commit()
+  local.bulk_changes = conn.total_changes
+ 
+ def _connect(self):
+  """Returns this thread's database connection, opening it if necessary.
+  
+  Connections are kept open for the lifetime of the thread (or until close()
+  or reopen() is called) so that queries do not have to reopen the database
+  and recompile their statements every time.  If the database file is
+  replaced, e.g. deleted and recreated, the connection is reopened.  A child
+  process (e.g. a forked Web server worker) opens its own connection instead
+  of using one that it inherited.
+  
+  """
+  local = self._local
+  conn = getattr(local, "conn", None)
+  if conn is not None:
+   if local.pid != os.getpid():
+    self.__drop_inherited_connection()
+    conn = None
+   elif local.epoch != self._connection_epoch:
+    self.close()
+    conn = None
+   elif time.time() - local.checked >= DB_REPLACED_CHECK_INTERVAL:
+    local.checked = time.time()
+    if self.__get_db_file_id() != local.file_id:
+     self.close()
+     conn = None
+  if conn is None:
+   conn = self.__open_db()
+  return conn
+ 
+ def __get_db_file_id(self):
+  try:
+   st = os.stat(os.path.realpath(self.database_path))
+  except EnvironmentError:
+   return None
+  return (st.st_dev, st.st_ino)
+ 
+ def __open_db(self):
+  conn = sqlite3.connect(self.database_path, timeout=DB_BUSY_TIMEOUT,
+                         cached_statements=STATEMENT_CACHE_SIZE)
+  # WAL mode is stored in the database file, so it only has to be set the
+  # first time.  Setting it again needs a lock, which fails immediately
+  # instead of waiting while another process is writing.  synchronous =
+  # NORMAL is safe in WAL mode and only fsyncs at checkpoints.
+  if conn.execute("PRAGMA journal_mode").fetchone()[0].lower() != "wal":
+   conn.execute("PRAGMA journal_mode = WAL")
+  conn.execute("PRAGMA synchronous = NORMAL")
+  conn.execute("PRAGMA mmap_size = %d" % DB_MMAP_SIZE)
+  q = self.queries["meta_table_from_schema"]
+  if not conn.execute(q).fetchall():
+   self.__create_db(conn)
+  # Temporary tables exist only for this connection and are created up front
+  # because DDL statements would commit any pending bulk transaction
+  temp_schema = """\
+CREATE TEMP TABLE "playlist_import" (
+ "position"    integer NOT NULL PRIMARY KEY,
+ "relpath"     text    NOT NULL
+);
+"""
+  conn.executescript(temp_schema)
+  local = self._local
+  local.conn = conn
+  local.epoch = self._connection_epoch
+  local.pid = os.getpid()
+  local.file_id = self.__get_db_file_id()
+  local.checked = time.time()
+  local.data_version = None
+  return conn
+ 
+ def __create_db(self, conn):
+  # Creates the tables in a new database.  This is done in a single write
+  # transaction, after checking again that the tables do not exist, because
+  # other processes may be opening the new database at the same time.
+  schema = """\
 CREATE TABLE "leviathan_meta" (
  "id"          integer NOT NULL PRIMARY KEY,
  "key"         text    NOT NULL UNIQUE,
@@ -1295,7 +2239,11 @@ CREATE TABLE "songs" (
  "sort_album"   text    NOT NULL,
  "length"       numeric,
  "disc_number"  numeric,
- "track_number" numeric
+ "track_number" numeric,
+ "mtime"        numeric,
+ "size"         integer,
+ "inode"        integer,
+ "content_hash" text
 );
 
 CREATE TABLE "playlists" (
@@ -1310,16 +2258,149 @@ CREATE TABLE "playlist_entries" (
 );
 
 CREATE INDEX "playlist_entries_song"     ON "playlist_entries" ("song");
-CREATE INDEX "playlist_entries_playlist" ON "playlist_entries" ("playlist");
+CREATE INDEX "playlist_entries_playlist_song" ON "playlist_entries" (
+ "playlist", "song"
+);
+
+CREATE INDEX "songs_album_artist" ON "songs" (
+ "album", "artist", "disc_number", "track_number", "sort_title", "sort_artist",
+ "sort_album", "length"
+);
+CREATE INDEX "songs_content_hash" ON "songs" ("content_hash");
+CREATE INDEX "songs_artist" ON "songs" (
+ "artist", "sort_title", "sort_artist", "sort_album", "length"
+);
+CREATE INDEX "songs_artist_album" ON "songs" (
+ "artist", "album", "sort_album", "sort_artist"
+);
+CREATE INDEX "songs_sort_title" ON "songs" (
+ "sort_title", "sort_artist", "sort_album", "length"
+);
 """
-   c.executescript(schema)
-   c.execute(self.queries["add_meta"], dict(key="db_version",value=DB_VERSION))
-   conn.commit()
-  return conn, c
+  conn.isolation_level = None
+  try:
+   conn.execute("BEGIN IMMEDIATE")
+   try:
+    if not conn.execute(self.queries["meta_table_from_schema"]).fetchall():
+     for statement in schema.split(";\n"):
+      if statement.strip():
+       conn.execute(statement)
+     self._create_search_index(conn)
+     conn.execute(self.queries["add_meta"],
+                  dict(key="db_version", value=DB_VERSION))
+   except:
+    conn.execute("ROLLBACK")
+    raise
+   conn.execute("COMMIT")
+  finally:
+   conn.isolation_level = ""
+ 
+ def _migrate(self):
+  # Upgrades the database schema to DB_VERSION using the steps in migrations.
+  # Each step runs in its own transaction along with the db_version update.
+  version = int(self.get_meta("db_version") or 0)
+  if version >= int(DB_VERSION):
+   return
+  if version < int(self.migrations[0].version) - 1:
+   raise Exception("the database schema version is too old to be upgraded;"
+                   " please delete and recreate the database")
+  conn = self._connect()
+  conn.commit()
+  conn.isolation_level = None
+  try:
+   for migration in self.migrations:
+    if int(migration.version) <= version:
+     continue
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+     # Another process may have upgraded the database in the meantime
+     q = self.queries["meta_value_from_key"]
+     version = int(conn.execute(q, dict(key="db_version")).fetchone()[0])
+     if version >= int(migration.version):
+      conn.execute("ROLLBACK")
+      continue
+     for statement in migration.statements:
+      conn.execute(statement)
+     if migration.backfill:
+      getattr(self, migration.backfill)(conn)
+     conn.execute(self.queries["update_meta"],
+                  dict(key="db_version", value=migration.version))
+    except:
+     conn.execute("ROLLBACK")
+     raise
+    conn.execute("COMMIT")
+  finally:
+   conn.isolation_level = ""
+ 
+ def _setup_db(self):
+  conn = self._connect()
+  return conn, conn.cursor()
+ 
+ def _increment_generation(self):
+  # Records that the library's contents changed, so that caches of it like
+  # snapshots are reloaded.  The generation is incremented in the same
+  # transaction as the changes, when they are committed (see _commit).
+  with self.bulk():
+   self._local.generation_changed = True
+ 
+ def _has_search_index(self):
+  return bool(self.query(self.queries["search_index_from_schema"]))
+ 
+ def _get_fingerprint(self, relpath):
+  # Returns the modification time, size, and inode of a song file, or None if
+  # it cannot be accessed.  Songs.scan uses these to skip unchanged files.
+  try:
+   st = os.stat(os.path.join(self.music_path, relpath))
+  except EnvironmentError:
+   return None
+  return (st.st_mtime, st.st_size, st.st_ino)
  
- def scan(self):
-  self.songs.scan()
-  self.playlists.scan()
+ def _get_content_hash(self, relpath):
+  # Returns a hash of a song file's size and its first and last
+  # CONTENT_HASH_BLOCK_SIZE bytes, or None if it cannot be read.  Songs.scan
+  # uses these to recognize songs that were moved outside of Leviathan
+  # without reading entire files.
+  try:
+   with open(os.path.join(self.music_path, relpath), "rb") as f:
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    h = hashlib.sha1(str(size))
+    f.seek(0)
+    h.update(f.read(CONTENT_HASH_BLOCK_SIZE))
+    if size > CONTENT_HASH_BLOCK_SIZE:
+     f.seek(max(CONTENT_HASH_BLOCK_SIZE, size - CONTENT_HASH_BLOCK_SIZE))
+     h.update(f.read())
+  except EnvironmentError:
+   return None
+  return h.hexdigest()
+ 
+ def scan(self, jobs=None, resume=False, progress=None, prune=False):
+  with self._lock_writers(), self.bulk():
+   r = self.songs.scan(jobs, resume, progress, prune)
+   self.playlists.scan()
+  return r
+ 
+ def _music_relpaths(self, paths):
+  # Returns the paths of the given absolute paths relative to the music
+  # folder, like relpath, but without resolving symlinks in every path.
+  # Paths that are not lexically within the music folder are passed to
+  # relpath.
+  return list(self._iter_music_relpaths(paths))
+ 
+ def _iter_music_relpaths(self, paths):
+  # Like _music_relpaths, but yields each relpath as paths (which may be an
+  # iterator) is read.
+  roots = [os.path.join(i, "") for i in
+           (os.path.abspath(self.music_path),
+            to_unicode(os.path.realpath(self.music_path.encode(FSENC)), FSENC))]
+  for path in paths:
+   path = os.path.normpath(to_unicode(path))
+   for root in roots:
+    if path.startswith(root):
+     yield path[len(root):]
+     break
+   else:
+    yield self.relpath(path, self.music_path)
  
  def abspath(self, child, parent, raise_error=True):
   child = to_unicode(child).encode(FSENC)
@@ -1329,6 +2410,48 @@ CREATE INDEX "playlist_entries_playlist" ON "playlist_entries" ("playlist");
    child = os.path.join(parent, child)
   return to_unicode(os.path.abspath(child), FSENC)
  
+ @contextlib.contextmanager
+ def bulk(self):
+  """Groups the database writes made in this thread into large transactions.
+  
+  Use this as a context manager around bulk operations like scans and
+  imports:
+  
+      with library.bulk():
+       for relpath in relpaths:
+        library.songs.add(relpath)
+  
+  Inside the block, changes are committed every BULK_BATCH_SIZE rows instead
+  of after every statement, and whatever is left is committed when the
+  outermost block exits.  If it exits with an exception, the uncommitted
+  changes are rolled back instead.  Blocks may be nested.
+  
+  Playlists that are saved inside the block are written to disk once, after
+  the outermost block exits (see Playlist.save).
+  
+  """
+  conn = self._connect()
+  local = self._local
+  local.bulk = getattr(local, "bulk", 0) + 1
+  if local.bulk == 1:
+   local.bulk_changes = conn.total_changes
+   local.unsaved_playlists = set()
+  try:
+   yield
+  except:
+   local.bulk -= 1
+   if not local.bulk:
+    local.generation_changed = False
+    self._connect().rollback()
+    # Earlier batches may have been committed
+    self.__save_playlists()
+   raise
+  else:
+   local.bulk -= 1
+   if not local.bulk:
+    self._commit(self._connect())
+    self.__save_playlists()
+ 
  def check_path(self, child, parent, raise_error=False):
   child = to_unicode(child).encode(FSENC)
   parent = to_unicode(parent).encode(FSENC)
@@ -1341,45 +2464,129 @@ CREATE INDEX "playlist_entries_playlist" ON "playlist_entries" ("playlist");
      raise ValueError("The path %s is not within %s" % (child, parent))
   return valid
  
+ def check_queries(self):
+  """Returns the queries that have to read an entire table.
+  
+  Each query with a WHERE clause in the `queries` dicts of the classes in this
+  module is run through EXPLAIN QUERY PLAN.  For each step of a plan that
+  reads an entire table instead of using an index, a tuple of the class name,
+  the query name, and the step's description is returned.  Query templates
+  (those with %s in them) are skipped.
+  
+  """
+  conn = self._connect()
+  q = """SELECT name FROM sqlite_master WHERE type = 'table'"""
+  tables = set([i[0] for i in conn.execute(q)])
+  r = []
+  for cls in (Albums, Artists, Playlist, Playlists, Song, Songs, Library):
+   for name in sorted(cls.queries):
+    q = cls.queries[name]
+    if "%s" in q or not re.search(r"\bWHERE\b", q, re.I):
+     continue
+    params = dict([(i, None) for i in re.findall(r":(\w+)", q)])
+    for step in conn.execute("EXPLAIN QUERY PLAN " + q, params):
+     m = FULL_SCAN_RE.match(step[-1])
+     if m and m.group(1) in tables:
+      r.append((cls.__name__, name, step[-1]))
+  return r
+ 
+ def close(self):
+  """Closes this thread's database connection, if it is open.
+  
+  The connection will be reopened automatically the next time it is needed.
+  
+  """
+  conn = getattr(self._local, "conn", None)
+  if conn is not None:
+   if self._local.pid != os.getpid():
+    self.__drop_inherited_connection()
+   else:
+    self._local.conn = None
+    conn.close()
+ 
+ def __drop_inherited_connection(self):
+  # Forgets this thread's connection, which was opened by the parent of this
+  # process.  Its SQLite handle, file descriptors, and WAL locks belong to
+  # the parent, so it must not be used, and closing it could checkpoint or
+  # unlock the database from under the parent.
+  _inherited_connections.append(self._local.conn)
+  self._local.conn = None
+ 
  def get_meta(self, key):
   r = self.query(self.queries["meta_value_from_key"], key=key)
   if r and r[0]:
    return r[0][0]
  
+ @property
+ def generation(self):
+  """A number that increases whenever the library's contents change.
+  
+  Each thread caches the value and only reads it from the database again when
+  PRAGMA data_version shows that another connection has committed changes,
+  or after this thread has changed the library, so checking it is cheap.
+  
+  """
+  conn = self._connect()
+  local = self._local
+  data_version = conn.execute(self.queries["data_version"]).fetchone()[0]
+  if local.data_version != data_version:
+   q = self.queries["meta_value_from_key"]
+   r = conn.execute(q, dict(key="generation")).fetchall()
+   local.generation = int(r[0][0]) if r else 0
+   local.data_version = data_version
+  return local.generation
+ 
  def move(self, src, dst):
   src = self.relpath(to_unicode(src), self.music_path)
   dst = self.relpath(to_unicode(dst), self.music_path)
-  cwd = os.getcwdu()
-  os.chdir(self.music_path)
-  if os.path.isdir(os.path.realpath(src)):
-   if not os.path.exists(dst):
-    os.mkdir(dst, 0755)
-   if not os.path.isdir(os.path.realpath(dst)):
-    raise ValueError("If src is a directory, dst must also be a directory or a"
-                     " symlink to one")
-   mvdir(src, dst, callback=self.songs._update_relpath)
-  else:
-   if os.path.isdir(os.path.realpath(dst)):
-    dst = os.path.join(dst, os.path.basename(src))
-   shutil.move(src, dst)
-   self.songs[src].relpath = dst
-  os.chdir(cwd)
-  src = os.path.join(self.music_path, src)
-  dst = os.path.join(self.music_path, dst)
-  for pls in self.playlists:
-   for path in pls.paths.values():
-    with open(path, "rb") as f:
-     s = to_unicode(f.read())
-    s = s.replace(src, dst)
-    with open(path, "wb") as f:
-     f.write(s.encode("utf8"))
+  # Absolute paths are used instead of changing the working directory, so
+  # that this is thread-safe
+  src_path = os.path.join(self.music_path, src)
+  dst_path = os.path.join(self.music_path, dst)
+  # Only the playlists that contain the moved songs are saved again
+  playlists = set()
+  with self.bulk():
+   if os.path.isdir(os.path.realpath(src_path)):
+    if not os.path.exists(dst_path):
+     os.mkdir(dst_path, 0755)
+    if not os.path.isdir(os.path.realpath(dst_path)):
+     raise ValueError("If src is a directory, dst must also be a directory or"
+                      " a symlink to one")
+    mvdir(src_path, dst_path)
+   else:
+    if os.path.isdir(os.path.realpath(dst_path)):
+     dst = os.path.join(dst, os.path.basename(src))
+     dst_path = os.path.join(self.music_path, dst)
+    shutil.move(src_path, dst_path)
+   self.songs._move(src, dst, playlists)
+  for name in sorted(playlists):
+   self.playlists[name].save()
+ 
+ def iter_query(self, query, **kwargs):
+  """Like query(), but yields the result rows as they are fetched.
+  
+  Rows are fetched QUERY_FETCH_SIZE at a time, so large results are never
+  loaded into memory all at once.  The query should not modify the database,
+  and the database should not be modified until the iterator is exhausted.
+  
+  """
+  c = self._connect().execute(query, kwargs)
+  try:
+   while True:
+    rows = c.fetchmany(QUERY_FETCH_SIZE)
+    if not rows:
+     break
+    for i in rows:
+     yield i
+  finally:
+   c.close()
  
  def query(self, query, **kwargs):
-  conn, c = self._setup_db()
-  c.execute(query, kwargs)
+  conn = self._connect()
+  c = conn.execute(query, kwargs)
   r = c.fetchall()
-  if conn.total_changes:
-   conn.commit()
+  # commit() does nothing if the query did not start a transaction
+  self._commit(conn)
   c.close()
   return r
  
@@ -1390,6 +2597,143 @@ CREATE INDEX "playlist_entries_playlist" ON "playlist_entries" ("playlist");
   ret = os.path.relpath(os.path.realpath(child), os.path.realpath(parent))
   return to_unicode(ret, FSENC)
  
+ def rebuild(self, jobs=None, progress=None):
+  """Rebuilds the database from scratch without disturbing its readers.
+  
+  The songs and playlists are scanned into a new database file next to the
+  current one (see scan() for jobs and progress), without saving the
+  playlists' files.  The new database gets the old one's metadata, and its
+  generation is greater than the old one's.  Then the new file is renamed
+  over the old one, and the playlists are saved like scan() does.
+  Connections in other threads and processes notice that the file changed
+  and reopen it, and they keep reading the old database until then.  If
+  database_path is a symlink, the file that it points to is replaced.
+  
+  Scans and watchers (see LibraryWatcher) cannot run during a rebuild, since
+  their changes would be lost.  If one is running, an Exception is raised.
+  
+  Returns the ScanResult of the songs scan.
+  
+  """
+  path = os.path.realpath(self.database_path)
+  dirname, basename = os.path.split(path)
+  lock = self._lock_writers(exclusive=True)
+  try:
+   fd, new_path = tempfile.mkstemp(prefix=basename + ".", dir=dirname)
+   os.close(fd)
+   new_path = to_unicode(new_path)
+   try:
+    # mkstemp makes the file private, but the Web app may run as another user
+    if os.path.exists(path):
+     os.chmod(new_path, stat.S_IMODE(os.stat(path).st_mode))
+    new = Library(dict(self.config, database_path=new_path))
+    conn = new._connect()
+    # Nothing reads the new database until it is finished, so there is no
+    # need to wait for each batch to reach the disk
+    conn.execute("PRAGMA synchronous = OFF")
+    with new.bulk():
+     r = new.songs.scan(jobs, progress=progress)
+     new.playlists.scan(save=False)
+     for key, value in self.query(self.queries["all_meta_keys_and_values"]):
+      if key not in ("db_version", "generation", "scan_checkpoint",
+                     "scan_progress"):
+       new.query(self.queries["set_meta"], key=key, value=value)
+     new.query(self.queries["set_meta"], key="generation",
+               value=unicode(self.generation + 1))
+    # The new database must not have -wal and -shm files, since they would
+    # not be renamed with it
+    conn.execute("PRAGMA journal_mode = DELETE")
+    new.close()
+    # The old database's WAL is emptied into it, and this thread's
+    # connection is closed, so that its -wal and -shm files can be deleted
+    self._connect().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    self.close()
+    os.rename(new_path, path)
+   except:
+    for i in (new_path, new_path + "-journal", new_path + "-wal",
+              new_path + "-shm"):
+     if os.path.exists(i):
+      os.remove(i)
+    raise
+   finally:
+    if os.path.exists(new_path + ".lock"):
+     os.remove(new_path + ".lock")
+   # Readers of the old database keep its -wal and -shm files open, so they
+   # are deleted right away so that new connections make new ones for the
+   # new database instead of sharing them
+   for i in (path + "-wal", path + "-shm"):
+    if os.path.exists(i):
+     os.remove(i)
+   self.reopen()
+   self.playlists.save()
+  finally:
+   lock.close()
+  return r
+ 
+ def _lock_writers(self, exclusive=False):
+  # Returns an open file that holds a lock on the database's lock file until
+  # it is closed.  Scans and watchers hold a shared lock, and rebuild() holds
+  # an exclusive one, so that the database is never replaced while another
+  # process is writing to it.  Raises an Exception instead of waiting if the
+  # lock is held by another process.
+  f = open(os.path.realpath(self.database_path) + ".lock", "a")
+  try:
+   fcntl.flock(f, (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) |
+                  fcntl.LOCK_NB)
+  except IOError as exc:
+   f.close()
+   if exc.errno not in (errno.EAGAIN, errno.EACCES):
+    raise
+   if exclusive:
+    raise Exception("the library is being scanned or watched by another"
+                    " process")
+   raise Exception("the database is being rebuilt by another process")
+  return f
+ 
+ def reopen(self):
+  """Makes every thread reopen its database connection before its next query.
+  
+  Call this after replacing the database file by some means that does not
+  change its inode, e.g. after restoring a backup into the same file.
+  
+  """
+  self._connection_epoch += 1
+  self.close()
+ 
+ def scan_progress(self):
+  """Returns the Songs.ScanProgress of the scan that is running, or None.
+  
+  The progress is updated every SCAN_CHECKPOINT_INTERVAL files.  A scan that
+  was interrupted leaves its last progress behind, so check how long ago it
+  was updated.
+  
+  """
+  value = self.get_meta("scan_progress")
+  if value != None:
+   return Songs.ScanProgress(*json.loads(value))
+ 
+ def snapshot(self):
+  """Returns a LibrarySnapshot of this library.
+  
+  The snapshot is shared by all threads and is replaced with a new one when
+  the library's generation changes.  While one thread is loading the new
+  snapshot, the other threads keep getting the old one.
+  
+  """
+  snapshot = self._snapshot
+  if snapshot != None and snapshot.generation == self.generation:
+   return snapshot
+  if not self._snapshot_lock.acquire(snapshot == None):
+   return snapshot
+  try:
+   snapshot = self._snapshot
+   generation = self.generation
+   if snapshot == None or snapshot.generation != generation:
+    snapshot = self._snapshot = LibrarySnapshot(self, generation)
+  finally:
+   self._snapshot_lock.release()
+  return snapshot
+ 
  def sanitize(self, directory="", quiet=False, debug=False, level=0):
   if directory == "":
    directory = self.music_path
@@ -1448,7 +2792,14 @@ CREATE INDEX "playlist_entries_playlist" ON "playlist_entries" ("playlist");
   if level == 0:
    return success
  
- def __set_meta(self, key):
+ def __save_playlists(self):
+  # Saves the playlists whose saving was put off by bulk()
+  names, self._local.unsaved_playlists = self._local.unsaved_playlists, set()
+  for name in sorted(names):
+   if name in self.playlists:
+    self.playlists[name].save()
+ 
+ def __set_meta(self, key, value):
   qname = "update_meta" if self.get_meta(key) != None else "add_meta"
   self.query(self.queries[qname], key=key, value=value)
  
@@ -1458,6 +2809,371 @@ CREATE INDEX "playlist_entries_playlist" ON "playlist_entries" ("playlist");
 
 # End of Library class
 
+class LibrarySnapshot(object):
+ """An in-memory, read-only copy of a library's songs, artists, albums, and
+playlists.
+
+Everything is loaded when the snapshot is created, sorted the same way as the
+corresponding Library collections, and indexed by ID or name, so that lookups
+do not touch the database.  Use Library.snapshot() to get a snapshot that is
+kept up to date.
+
+"""
+ queries = {
+  "all_playlist_entries": """SELECT playlist, song FROM playlist_entries"""
+ }
+ Playlist = collections.namedtuple("Playlist", "id name songs")
+ 
+ def __init__(self, library, generation=None):
+  self.library = library
+  # Read the generation first so that changes made while loading cause the
+  # snapshot to be reloaded
+  self.generation = library.generation if generation == None else generation
+  self.songs = tuple(library.songs.all())
+  self.__songs = dict((i.id, i) for i in self.songs)
+  # Artists, ordered by their lowest sort value and then by name
+  by_artist = {}
+  artist_keys = {}
+  for song in self.songs:
+   by_artist.setdefault(song.artist, []).append(song)
+   key = artist_keys.setdefault(song.artist, song.sort_artist)
+   artist_keys[song.artist] = min(key, song.sort_artist)
+  self.artists = tuple(
+   Artists.Artist(name=name, library=library, songs=tuple(by_artist[name]))
+   for name in sorted(by_artist, key=lambda i: (artist_keys[i], i))
+  )
+  self.__artists = dict((i.name, i) for i in self.artists)
+  # Albums, ordered by their lowest sort values and then by name and artist
+  by_album = {}
+  album_keys = {}
+  for song in self.songs:
+   name = (song.album, song.artist)
+   by_album.setdefault(name, []).append(song)
+   key = album_keys.setdefault(name, (song.sort_album, song.sort_artist))
+   album_keys[name] = (min(key[0], song.sort_album),
+                       min(key[1], song.sort_artist))
+  self.albums = tuple(
+   Albums.Album(name=name[0], artist=name[1], library=library,
+                songs=tuple(sorted(by_album[name],
+                                   key=lambda i: (i.disc_number,
+                                                  i.track_number))))
+   for name in sorted(by_album, key=lambda i: (album_keys[i], i))
+  )
+  self.__albums = dict(((i.name, i.artist), i) for i in self.albums)
+  self.__artist_albums = {}
+  for album in self.albums:
+   self.__artist_albums.setdefault(album.artist, []).append(album)
+  # Playlists, ordered by name, with their songs in the same order as
+  # self.songs
+  positions = dict((song.id, n) for n, song in enumerate(self.songs))
+  entries = {}
+  q = self.queries["all_playlist_entries"]
+  for playlist, song in library.iter_query(q):
+   if song in positions:
+    entries.setdefault(playlist, []).append(positions[song])
+  q = Playlists.queries["all_playlists"]
+  self.playlists = tuple(
+   self.Playlist(id=id_, name=name,
+                 songs=tuple(self.songs[i] for i in
+                             sorted(entries.get(id_, ()))))
+   for id_, name in library.query(q)
+  )
+  self.__playlists = dict((i.id, i) for i in self.playlists)
+ 
+ def album(self, artist, album):
+  try:
+   return self.__albums[(album, artist)]
+  except KeyError:
+   raise IndexError("no album named '%s' by artist '%s'" % (album, artist))
+ 
+ def artist(self, name):
+  try:
+   return self.__artists[name]
+  except KeyError:
+   raise IndexError("no artist named '%s'" % name)
+ 
+ def artist_albums(self, artist):
+  try:
+   return tuple(self.__artist_albums[artist])
+  except KeyError:
+   raise IndexError("no artist named '%s'" % artist)
+ 
+ def playlist(self, id_):
+  try:
+   return self.__playlists[id_]
+  except KeyError:
+   raise IndexError("There is no playlist with the id %d" % id_)
+ 
+ def song(self, id_):
+  try:
+   return self.__songs[id_]
+  except KeyError:
+   raise IndexError("There is no song with the id %d" % id_)
+
+class LibraryWatcher(object):
+ """Keeps a library's database up to date with changes to its files.
+
+run() watches the music folder and the default playlist folder and, after
+each burst of changes, adds, updates, moves, or removes only the songs and
+playlists whose files changed.  It uses inotify (via pyinotify) if it is
+installed and otherwise checks the folders every poll_interval seconds.
+Like scans, it does not remove more than SCAN_PRUNE_MAX_FRACTION of the
+songs at once.
+
+"""
+ Result = collections.namedtuple("Result",
+                                 "added updated moved removed playlists")
+ 
+ def __init__(self, library, debounce=WATCH_DEBOUNCE,
+              poll_interval=WATCH_POLL_INTERVAL, callback=None):
+  self.library = library
+  self.debounce = debounce
+  self.poll_interval = poll_interval
+  # Called with the result of each apply()
+  self.callback = callback
+  # Song relpaths (files or folders) and playlist names that changed, and
+  # (old relpath, new relpath) pairs for moved songs or folders
+  self.__paths = set()
+  self.__playlists = set()
+  self.__moves = []
+  self.__first_change = self.__last_change = None
+  self.__playlist_mtimes = None
+ 
+ def _music_path_changed(self, path, is_dir=False):
+  # Records a change to a file or folder, given by its absolute path, in the
+  # music folder
+  if is_dir or get_format(os.path.splitext(path)[1]):
+   self.__paths.add(self.library._music_relpaths([path])[0])
+   self.__touch()
+ 
+ def _music_path_moved(self, src, dst):
+  # Records that a file or folder was moved within the music folder
+  src, dst = self.library._music_relpaths([src, dst])
+  self.__moves.append((src, dst))
+  self.__paths.add(dst)
+  self.__touch()
+ 
+ def _playlist_path_changed(self, path):
+  # Records a change to a file in the default playlist folder
+  ext = self.library.playlist_formats.default.ext
+  name, file_ext = custom_splitext(os.path.basename(to_unicode(path, FSENC)),
+                                   ext)
+  if file_ext == ext and name not in self.library.db_ignore_playlists:
+   self.__playlists.add(name)
+   self.__touch()
+ 
+ def __touch(self):
+  now = time.time()
+  if self.__first_change == None:
+   self.__first_change = now
+  self.__last_change = now
+ 
+ @property
+ def pending(self):
+  """True if there are changes that have not been applied yet."""
+  return bool(self.__paths or self.__playlists or self.__moves)
+ 
+ @property
+ def ready(self):
+  """True if there are pending changes and it is time to apply them."""
+  if not self.pending:
+   return False
+  now = time.time()
+  return (now - self.__last_change >= self.debounce or
+          now - self.__first_change >= WATCH_MAX_DELAY)
+ 
+ def apply(self):
+  """Applies the pending changes to the database and returns a Result.
+  
+  The changes stay pending until they have all been applied, so if an error
+  occurs, they are applied again the next time.  Applying a change again
+  does nothing if it was already committed.
+  
+  """
+  library = self.library
+  paths = set(self.__paths)
+  moves = list(self.__moves)
+  playlist_names = set(self.__playlists)
+  stats = dict(added=0, updated=0, moved=0, removed=0, unchanged=0)
+  # Playlists whose files have to be saved again
+  playlists = set()
+  conn, c = library._setup_db()
+  with library.bulk():
+   for src, dst in moves:
+    stats["moved"] += library.songs._move(src, dst, playlists)
+   known = {}
+   relpaths = set()
+   for path in paths:
+    fingerprints = self.__db_fingerprints(path)
+    known.update(fingerprints)
+    relpaths.update(fingerprints)
+    relpaths.update(self.__file_relpaths(path))
+   changed = {}
+   missing = set()
+   for relpath in sorted(relpaths):
+    fingerprint = library._get_fingerprint(relpath)
+    if fingerprint == None:
+     if relpath in known:
+      missing.add(relpath)
+    elif known.get(relpath) != fingerprint:
+     changed[relpath] = (fingerprint, relpath in known, None)
+   library.songs._move_or_remove(missing, changed, stats, playlists)
+   updated = [i for i in sorted(changed) if changed[i][1]]
+   infos = itertools.imap(library._get_song_info_and_hash, sorted(changed))
+   library.songs._save_infos(infos, changed, stats)
+   for relpath in updated:
+    playlists.update(i.name for i in library.songs[relpath].playlists)
+   for name in sorted(playlist_names):
+    path = os.path.join(library.playlists_path,
+                        name + library.playlist_formats.default.ext)
+    # Playlists that are imported from their files are not saved again,
+    # since saving them would cause them to be imported again
+    if os.path.exists(path):
+     try:
+      Playlist._add(conn, c, library, name, True)
+     except ValueError as exc:
+      # A malformed file is left alone until it changes again
+      sys.stderr.write((u"warning: skipping playlist %s: %s\n"
+                        % (name, exc)).encode("utf8"))
+      playlists.discard(name)
+    elif name in library.playlists:
+     library.playlists[name].remove()
+     playlists.discard(name)
+  c.close()
+  for name in sorted(playlists):
+   if name in library.playlists:
+    library.playlists[name].save()
+  # Only the changes applied above are removed, in case more were recorded
+  self.__paths -= paths
+  del self.__moves[:len(moves)]
+  self.__playlists -= playlist_names
+  if not self.pending:
+   self.__first_change = self.__last_change = None
+  r = self.Result(added=stats["added"], updated=stats["updated"],
+                  moved=stats["moved"], removed=stats["removed"],
+                  playlists=len(playlists))
+  if callable(self.callback):
+   self.callback(r)
+  return r
+ 
+ def __apply(self):
+  # Used by run() so that an error in one batch does not stop the watcher;
+  # the batch's changes stay pending, so they are retried
+  try:
+   self.apply()
+  except Exception as exc:
+   sys.stderr.write((u"error: could not apply changes (will retry): %s\n"
+                     % exc).encode("utf8"))
+ 
+ def __db_fingerprints(self, relpath):
+  # Returns a dict of the relpaths of the songs in the database that are at
+  # relpath or in the folder at relpath to their fingerprints.
+  library = self.library
+  if relpath in ("", "."):
+   r = library.query(library.songs.queries["all_fingerprints"])
+  else:
+   q = library.songs.queries["fingerprints_from_range"]
+   r = library.query(q, **_relpath_range(relpath))
+   q = library.songs.queries["fingerprint_from_relpath"]
+   r += library.query(q, relpath=relpath)
+  return dict((i[0], tuple(i[1:])) for i in r)
+ 
+ def __file_relpaths(self, relpath):
+  # Yields the relpaths of the song files that are at relpath or in the
+  # folder at relpath.
+  path = os.path.join(self.library.music_path, relpath)
+  if os.path.isdir(path):
+   for root, dirs, files in os.walk(path.encode(FSENC), followlinks=True):
+    root = to_unicode(root, FSENC)
+    for i in files:
+     if get_format(os.path.splitext(i)[1]):
+      i = os.path.join(root, to_unicode(i, FSENC))
+      yield self.library._music_relpaths([i])[0]
+  elif os.path.isfile(path) and get_format(os.path.splitext(path)[1]):
+   yield relpath
+ 
+ def poll(self):
+  """Records every change made since the last call to poll().
+  
+  The music folder is walked and the modification times of the files in the
+  default playlist folder are compared with the previous call's; only the
+  song files whose modification time, size, or inode changed have their tags
+  read when the changes are applied, and songs that were moved are recognized
+  by their content hashes.
+  
+  """
+  self._music_path_changed(self.library.music_path, True)
+  mtimes = {}
+  for i in os.listdir(self.library.playlists_path):
+   path = os.path.join(self.library.playlists_path, i)
+   try:
+    mtimes[i] = os.stat(path).st_mtime
+   except EnvironmentError:
+    # The file was deleted or renamed after it was listed
+    continue
+  # The first time, every playlist file is imported, but playlists without
+  # files are only removed once their files are seen to disappear
+  previous = self.__playlist_mtimes or {}
+  for i in set(mtimes) | set(previous):
+   if mtimes.get(i) != previous.get(i):
+    self._playlist_path_changed(i)
+  self.__playlist_mtimes = mtimes
+ 
+ def run(self, use_inotify=True):
+  """Watches for changes and applies them until interrupted.
+  
+  If use_inotify is False or pyinotify is not installed, the folders are
+  polled instead.  An Exception is raised if the database is being rebuilt
+  (see Library.rebuild), and the database cannot be rebuilt while this runs.
+  
+  """
+  # Held until run() returns
+  lock = self.library._lock_writers()
+  pyinotify = None
+  if use_inotify:
+   try:
+    import pyinotify
+   except ImportError:
+    pass
+  if pyinotify == None:
+   while True:
+    self.poll()
+    self.__apply()
+    time.sleep(self.poll_interval)
+  watcher = self
+  class Handler(pyinotify.ProcessEvent):
+   def process_default(self, event):
+    path = to_unicode(event.pathname, FSENC)
+    if event.wd == playlists_wd:
+     watcher._playlist_path_changed(path)
+    elif event.mask & pyinotify.IN_MOVED_TO and \
+         getattr(event, "src_pathname", None):
+     watcher._music_path_moved(to_unicode(event.src_pathname, FSENC), path)
+    else:
+     watcher._music_path_changed(path, event.dir)
+  mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE |
+          pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM |
+          pyinotify.IN_MOVED_TO)
+  wm = pyinotify.WatchManager()
+  notifier = pyinotify.Notifier(wm, Handler())
+  playlists_path = self.library.playlists_path.encode(FSENC)
+  playlists_wd = wm.add_watch(playlists_path, mask)[playlists_path]
+  wm.add_watch(self.library.music_path.encode(FSENC), mask, rec=True,
+               auto_add=True)
+  # Catch up with the changes made while nothing was watching
+  self.poll()
+  self.__apply()
+  try:
+   while True:
+    if notifier.check_events(int(self.debounce * 1000)):
+     notifier.read_events()
+     notifier.process_events()
+    if self.ready:
+     self.__apply()
+  finally:
+   notifier.stop()
+
+
 class PlaylistFormatSettings(dict):
  Entry = collections.namedtuple("PlaylistFormatSettingsEntry",
           "dirname ext default format title_format mp3_only absolute_paths"
@@ -1500,6 +3216,38 @@ def apic_extract(mp3, jpg=None):
   return True
  return data
 
+def atomic_write(path, data):
+ """Replaces the file at path with one containing data (a byte string).
+ 
+ The data is written to a temporary file in the same folder and flushed to
+ the disk, and then the temporary file is renamed over path, so readers and
+ crashes leave either the old file or the new one and never a partial one.
+ The temporary file's name starts with a dot and ends with ".tmp".  An
+ existing file's permissions are kept, and if path is a symlink, the file it
+ points to is replaced.
+ 
+ """
+ path = os.path.realpath(path)
+ dirname, basename = os.path.split(path)
+ tmp = os.path.join(dirname, ".%s.%d.%d.tmp" % (
+  basename, os.getpid(), threading.current_thread().ident
+ ))
+ try:
+  fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+  with os.fdopen(fd, "wb") as f:
+   f.write(data)
+   f.flush()
+   os.fsync(f.fileno())
+  try:
+   os.chmod(tmp, stat.S_IMODE(os.stat(path).st_mode))
+  except EnvironmentError:
+   pass
+  os.rename(tmp, path)
+ except:
+  if os.path.lexists(tmp):
+   os.remove(tmp)
+  raise
+
 def convert_to_mp3(in_file, out_file, ffmpeg_path, lame_path,
                    constant_bitrate=None, vbr_quality=None):
  if _GPL:
@@ -1565,14 +3313,29 @@ def get_format(ext):
   return EXTENSIONS[ext]
  return None
 
+def get_number_tag(mg, tag):
+ """Returns the first number in a disc or track number tag, or None."""
+ value = DISC_TRACK_NUMBER_RE.sub("/", mg.get(tag, [""])[0]).split("/")[0]
+ return int(value) if value else None
+
 def main(argv):
- commands = ["sanitize", "to-mp3", "scan", "song", "playlist", "pls", "move",
-             "mv", "help", "-h", "--help"]
+ commands = ["sanitize", "to-mp3", "scan", "rebuild", "watch", "song",
+             "playlist", "pls", "move", "mv", "check-queries", "help", "-h",
+             "--help"]
  usage = """Usage: %s command [arguments]
 
 Commands:        Arguments:
-scan
- Adds all songs in the library and all playlists to the database.
+scan             [songs|playlists|pls|all] [-j|--jobs N] [--resume] [--prune]
+ Adds all songs in the library and all playlists to the database, reading
+ tags with N processes in parallel if -j is given.  Progress is printed to
+ standard error.  --resume continues an interrupted scan from where it left
+ off.  --prune removes missing songs even if most of the library is missing.
+rebuild          [-j|--jobs N]
+ Scans everything into a new database and then replaces the current one with
+ it, so that programs using the database never see a partial library.
+watch            [--poll]
+ Keeps the database up to date with changes to song and playlist files until
+ interrupted, using inotify if pyinotify is installed and --poll is not given.
 move|mv          src dst
  Moves a song in the filesystem and updates the database and playlists to match.
 playlist|pls     add|del|delete|ls|save playlist-name
@@ -1589,10 +3352,13 @@ playlist|pls     move|mv song-path old-playlist-name new-playlist-name
  Moves a song from one playlist to another playlist.
 sanitize
  Fixes permissions and makes sure all albums with artwork have an albumart.jpg.
+check-queries
+ Lists database queries that read an entire table instead of using an index.
 song             add|update|remove|rm song-path
  Adds, updates, or removes a song in the database (DOES NOT affect the file).
 song             find|path[s]|search [database-field [title]] search-term
  Searches for the given text in the list of songs and prints all matching paths.
+ Use the database-field "any" to search titles, artists, albums, and paths.
 to-mp3
  Makes sure MP3 versions of all songs and playlists exist.
 help|-h|--help
@@ -1635,18 +3401,77 @@ help|-h|--help
   print "error:", exc
   return 1
  
- # Scan command
- if cmd == "scan":
-  if (len(argv) not in (2, 3)) or \
-     (len(argv) == 3 and argv[2] not in ("songs", "playlists", "pls", "all")):
-   print "Usage: %s scan [songs|playlists|pls|all]" % argv[0]
-   return 2
-  if len(argv) == 3 and argv[2] == "songs":
-   library.songs.scan()
-  elif len(argv) == 3 and argv[2] in ("playlists", "pls"):
-   library.playlists.scan()
+ # Scan and rebuild commands
+ if cmd in ("scan", "rebuild"):
+  jobs = None
+  for i in ("-j", "--jobs"):
+   if i in argv[2:-1]:
+    jobs = argv.pop(argv.index(i) + 1)
+    argv.remove(i)
+  for i in argv[2:]:
+   if i.startswith("--jobs="):
+    jobs = i.split("=", 1)[1]
+    argv.remove(i)
+  if jobs != None:
+   jobs = int(jobs) if jobs.isdigit() else 0
+  resume = "--resume" in argv[2:]
+  if resume:
+   argv.remove("--resume")
+  prune = "--prune" in argv[2:]
+  if prune:
+   argv.remove("--prune")
+  tty = sys.stderr.isatty()
+  printed = dict(time=0, any=False)
+  def progress(p):
+   if p.updated - printed["time"] < (SCAN_PROGRESS_INTERVAL if tty else
+                                     SCAN_PROGRESS_LOG_INTERVAL) and \
+      p.done < p.total:
+    return
+   eta = p.eta
+   line = "%d/%d files, %.1f files/s, %.1f MiB read, ETA %s" % (
+    p.done, p.total, p.rate, p.size / 1048576.0,
+    "%d:%02d:%02d" % (eta // 3600, eta // 60 % 60, eta % 60)
+    if eta != None else "unknown"
+   )
+   sys.stderr.write(("\r%s\033[K" if tty else "%s\n") % line)
+   sys.stderr.flush()
+   printed.update(time=p.updated, any=True)
+  if cmd == "rebuild":
+   if len(argv) != 2 or jobs == 0 or resume or prune:
+    print "Usage: %s rebuild [-j|--jobs N]" % argv[0]
+    return 2
+   r = library.rebuild(jobs, progress)
   else:
-   library.scan()
+   if (len(argv) not in (2, 3)) or \
+      (len(argv) == 3 and argv[2] not in ("songs","playlists","pls","all")) or \
+      (jobs == 0):
+    print ("Usage: %s scan [songs|playlists|pls|all] [-j|--jobs N] [--resume]"
+           " [--prune]" % argv[0])
+    return 2
+   if len(argv) == 3 and argv[2] == "songs":
+    r = library.songs.scan(jobs, resume, progress, prune)
+   elif len(argv) == 3 and argv[2] in ("playlists", "pls"):
+    r = library.playlists.scan()
+   else:
+    r = library.scan(jobs, resume, progress, prune)
+  if tty and printed["any"]:
+   sys.stderr.write("\n")
+  if r:
+   print "%d added, %d updated, %d moved, %d removed, %d unchanged" % r
+ # Watch command
+ elif cmd == "watch":
+  if len(argv) > 3 or (len(argv) == 3 and argv[2] != "--poll"):
+   print "Usage: %s watch [--poll]" % argv[0]
+   return 2
+  def callback(r):
+   if any(r):
+    print ("%d added, %d updated, %d moved, %d removed, %d playlists saved"
+           % r)
+    sys.stdout.flush()
+  try:
+   LibraryWatcher(library, callback=callback).run(len(argv) == 2)
+  except KeyboardInterrupt:
+   pass
  # Move command
  elif cmd in ("move", "mv"):
   if len(argv) < 4:
@@ -1709,7 +3534,8 @@ help|-h|--help
   # Multiple playlists - requires a song path to be specified
   else:
    playlist_names = [fix_cli_playlist_name(library, i) for i in argv[4:]]
-   song = library.songs.add(library.relpath(argv[3], library.music_path))
+   with library.bulk():
+    song = library.songs.add(library.relpath(argv[3], library.music_path))
    # Playlist - Remove song confirmation
    if argv[2] in ("remove", "rm"):
     r = yes_no_prompt("Are you sure you want to remove %s from the"
@@ -1759,7 +3585,8 @@ help|-h|--help
    return 2
   # Song - Add/Update
   if argv[2] in ("add", "update"):
-   library.songs.add(library.relpath(argv[3], library.music_path))
+   with library.bulk():
+    library.songs.add(library.relpath(argv[3], library.music_path))
   # Song - Remove song
   if argv[2] in ("remove", "rm"):
    song = library.songs[library.relpath(argv[3], library.music_path)]
@@ -1782,14 +3609,32 @@ help|-h|--help
     if term == "":
      print "Please specify the name of a song."
      return 2
+   if field == "any":
+    field = None
    for i in library.songs.search(field, term, exact=False, sort="relpath"):
-    print i.relpath
+    print i.relpath.encode("utf8")
    return 0
  # to-mp3 command
  elif cmd == "to-mp3":
   library.to_mp3()
+ # Check queries command
+ elif cmd == "check-queries":
+  r = library.check_queries()
+  for owner, name, detail in r:
+   print "%s.queries[%r]: %s" % (owner, name, detail)
+  if r:
+   return 1
  return 0
 
+def filter_id_slice(rows, start, step):
+ # Takes rows from a query for an ID range, ordered by ID with the ID in the
+ # first column, and returns the ones that xrange(start, stop, step) would
+ # include, in that order.
+ rows = [i for i in rows if (i[0] - start) % step == 0]
+ if step < 0:
+  rows.reverse()
+ return rows
+
 def fix_cli_playlist_name(library, name):
  if "/" in name:
   name = os.path.relpath(name, library.playlists_path)
@@ -1797,23 +3642,83 @@ def fix_cli_playlist_name(library, name):
  return name
 
 def mvdir(src, dst, callback=None, _first_level=True):
+ """Moves the contents of the folder src into the folder dst and removes src.
+ 
+ dst is created if it does not exist.  If src and dst are on the same
+ filesystem, each file or folder in src that is not also a folder in dst is
+ renamed into dst as a whole (or src itself is renamed if dst is empty), and
+ folders that are in both are merged.  Otherwise, the files are copied by
+ MOVE_COPY_THREADS threads and each copy is compared with its original
+ before src is removed.
+ 
+ callback, if given, is called with the source and destination paths of each
+ file or folder that was moved as a whole.
+ 
+ """
+ if _first_level and callback != None and not callable(callback):
+  raise TypeError("callback is not callable")
  if not os.path.exists(dst):
   os.mkdir(dst, 0755)
  if not os.path.isdir(os.path.realpath(src)):
   raise ValueError("%s is not a directory" % src)
  if not os.path.isdir(os.path.realpath(dst)):
   raise ValueError("%s is not a directory" % dst)
+ if os.stat(src).st_dev != os.stat(dst).st_dev:
+  _copy_tree(src, dst, callback)
+  shutil.rmtree(src)
+  return
+ if not os.path.islink(src) and not os.path.islink(dst) and \
+    not os.listdir(dst):
+  os.rename(src, dst)
+  if callback:
+   callback(src, dst)
+  return
  for i in os.listdir(src):
   src_p, dst_p = os.path.join(src, i), os.path.join(dst, i)
-  if os.path.isdir(os.path.realpath(src_p)):
+  if os.path.isdir(os.path.realpath(src_p)) and \
+     os.path.isdir(os.path.realpath(dst_p)):
    mvdir(src_p, dst_p, callback, False)
-  else:
-   shutil.move(src_p, dst_p)
-  if callable(callback):
+   continue
+  shutil.move(src_p, dst_p)
+  if callback:
    callback(src_p, dst_p)
  os.rmdir(src)
- if _first_level and callback != None and not callable(callback):
-  raise TypeError("callback is not callable")
+
+def _copy_tree(src, dst, callback=None):
+ # Copies the contents of the folder src into the folder dst for mvdir, using
+ # MOVE_COPY_THREADS threads, and raises an error if any copy differs from
+ # its original.
+ pairs = []
+ for root, dirs, files in os.walk(src, followlinks=True):
+  relpath = os.path.relpath(root, src)
+  dst_root = dst if relpath == "." else os.path.join(dst, relpath)
+  if not os.path.isdir(dst_root):
+   os.mkdir(dst_root, 0755)
+  for i in files:
+   pairs.append((os.path.join(root, i), os.path.join(dst_root, i)))
+ pool = multiprocessing.pool.ThreadPool(MOVE_COPY_THREADS)
+ try:
+  for src_p, dst_p in pool.imap(_copy_file, pairs):
+   if callback:
+    callback(src_p, dst_p)
+ finally:
+  pool.close()
+  pool.join()
+
+def _copy_file(pair):
+ # Copies a file for _copy_tree and checks that the copy is complete
+ src, dst = pair
+ shutil.copy2(src, dst)
+ if not filecmp.cmp(src, dst, shallow=False):
+  raise IOError("%s was not copied correctly to %s" % (src, dst))
+ return pair
+
+def _relpath_range(relpath):
+ # Returns the parameters low and high for queries that select the songs in
+ # the folder at relpath with "relpath >= :low AND relpath < :high".  A range
+ # is used instead of LIKE so that the relpath index is used; "0" is the
+ # character after "/".
+ return dict(low=relpath + "/", high=relpath + "0")
 
 def setattrs(d, _cls = None):
  setattrs_class = _cls
@@ -1828,6 +3733,21 @@ def setattrs(d, _cls = None):
   return setattrs_class
 
 def sort_value(s):
+ # Artist and album names repeat for every song on an album, so the results
+ # are cached; the cache is simply emptied when it fills up.
+ try:
+  return _sort_value_cache[s]
+ except KeyError:
+  pass
+ except TypeError:
+  return _sort_value(s)
+ ret = _sort_value(s)
+ if len(_sort_value_cache) >= SORT_VALUE_CACHE_SIZE:
+  _sort_value_cache.clear()
+ _sort_value_cache[s] = ret
+ return ret
+
+def _sort_value(s):
  s = to_unicode(strip_latin_diacritics(s)).lower()
  if s.startswith("the "):
   s = s.replace("the ", "", 1) + ", the"
@@ -1837,6 +3757,8 @@ def sort_value(s):
   s = s.replace("a ", "", 1) + ", a"
  return s
 
+_sort_value_cache = {}
+
 # replace Latin letters with diacritical marks with the same letters without
 # diacritics, preserving case
 
@@ -1906,12 +3828,21 @@ for letter in LATIN_DIACRITICS:
  variants = LATIN_DIACRITICS[letter]
  LATIN_DIACRITICS[letter] = unicodedata.normalize("NFKC", variants)
 
+# unicode.translate table of code point -> plain letter(s), built from
+# LATIN_DIACRITICS.  Some variants are written as a base letter followed by a
+# combining mark; each code point is mapped on its own, and when one appears
+# under several letters the first letter in dictionary order wins, which is
+# what replacing the variants one letter at a time used to do.
+LATIN_DIACRITICS_TABLE = {}
+for letter in LATIN_DIACRITICS:
+ for variant in LATIN_DIACRITICS[letter]:
+  if variant != letter:
+   LATIN_DIACRITICS_TABLE.setdefault(ord(variant), unicode(letter))
+del letter, variant, variants
+
 def strip_latin_diacritics(source):
  ret = unicodedata.normalize("NFKC", to_unicode(source))
- for letter in LATIN_DIACRITICS:
-  for variant in LATIN_DIACRITICS[letter]:
-   ret = ret.replace(variant, letter)
- return ret
+ return ret.translate(LATIN_DIACRITICS_TABLE)
 
 def get_default_config_path():
  conf_file = os.path.expanduser("~/.leviathan.yml")
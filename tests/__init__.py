@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+# Tests for Leviathan.  Run them from the repository's root folder with:
+# 
+#     python2 -m unittest discover
+# 
+# The tests that read tags need Mutagen and are skipped without it.
+
+import os
+import shutil
+import tempfile
+
+try:
+ from mutagen.easyid3 import EasyID3
+except ImportError:
+ EasyID3 = None
+
+# A silent MPEG-1 Layer III frame (128 kbps, 44.1 kHz), repeated to make stub
+# songs that Mutagen can read
+MP3_FRAME = b"\xff\xfb\x90\x00" + b"\x00" * 413
+ARTISTS = (u"The Beatles", u"Björk", u"Ænima", u"A Band", u"Zed")
+
+def make_library(root, count):
+ """Creates `count` tagged stub MP3 files in a new library under root.
+ 
+ The songs are spread over several artists and albums, some of them with
+ non-ASCII names.  Returns a config dict for Library.
+ 
+ """
+ music_path = os.path.join(root, "music")
+ playlists_path = os.path.join(root, "playlists")
+ os.makedirs(playlists_path)
+ for n in range(count):
+  artist = ARTISTS[n % len(ARTISTS)]
+  album = u"Album %d" % (n % 3)
+  folder = os.path.join(music_path, artist.encode("utf8"),
+                        album.encode("utf8"))
+  if not os.path.isdir(folder):
+   os.makedirs(folder)
+  path = os.path.join(folder, "%03d song.mp3" % n)
+  with open(path, "wb") as f:
+   f.write(MP3_FRAME * 20)
+  tags = EasyID3()
+  tags["title"] = u"Sóng %d" % n
+  tags["artist"] = artist
+  tags["album"] = album
+  tags["tracknumber"] = u"%d/10" % (n % 10 + 1)
+  tags["discnumber"] = u"1"
+  tags.save(path)
+ return dict(
+  music_path=music_path,
+  database_path=os.path.join(root, "leviathan.sqlite"),
+  albumart_filename="albumart.jpg",
+  playlist_formats={playlists_path: dict(default=True, format="m3u")},
+  db_ignore_playlists=[],
+  ffmpeg="ffmpeg",
+  lame="lame",
+  constant_bitrate="256k",
+  vbr_quality=0
+ )
+
+class TemporaryLibraryMixin(object):
+ # Gives each test a library of SONG_COUNT songs in a temporary folder as
+ # self.config; subclasses must also inherit from unittest.TestCase
+ SONG_COUNT = 100
+ 
+ def setUp(self):
+  if EasyID3 == None:
+   self.skipTest("Mutagen is not installed")
+  self.root = tempfile.mkdtemp(prefix="leviathan-test.")
+  self.addCleanup(shutil.rmtree, self.root, True)
+  self.config = make_library(self.root, self.SONG_COUNT)
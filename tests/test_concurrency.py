@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+import imp
+import json
+import multiprocessing
+import os
+import traceback
+import unittest
+import wsgiref.util
+
+import yaml
+
+import leviathan
+
+from tests import TemporaryLibraryMixin
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The Web app's lists that the Web readers request, with their query strings
+WEB_LISTS = (("songs", ""), ("artists", ""), ("albums", ""),
+             ("search", "q=s%C3%B3ng"))
+
+def _check_snapshot(snapshot, previous, errors):
+ # Checks that a snapshot is consistent with itself and not older than the
+ # previous one (a (generation, song count) pair), and returns its own pair
+ generation, songs = snapshot.generation, len(snapshot.songs)
+ if generation < previous[0]:
+  errors.append("generation went from %d to %d" % (previous[0], generation))
+ if songs < previous[1]:
+  errors.append("song count went from %d to %d" % (previous[1], songs))
+ if sum(len(i.songs) for i in snapshot.artists) != songs or \
+    sum(len(i.songs) for i in snapshot.albums) != songs:
+  errors.append("artists or albums do not match songs at generation %d"
+                % generation)
+ return generation, songs
+
+def _read_library(config, stop, results):
+ # Runs in a reader process:  reads the library the way the Web app does
+ # until stop is set, and puts a list of errors and the final song count in
+ # results
+ errors = []
+ previous = (0, 0)
+ try:
+  library = leviathan.Library(config)
+  while True:
+   done = stop.is_set()
+   try:
+    snapshot = library.snapshot()
+    previous = _check_snapshot(snapshot, previous, errors)
+    for artist in snapshot.artists:
+     snapshot.artist_albums(artist.name)
+    library.songs.search(None, u"sóng", exact=False, sort="rank", limit=50)
+   except Exception:
+    errors.append(traceback.format_exc())
+   if done:
+    break
+ except Exception:
+  errors.append(traceback.format_exc())
+ results.put((errors, previous[1]))
+
+def _read_web_lists(web_root, stop, results):
+ # Like _read_library, but requests the /list/* routes of a Web app worker
+ # whose files are in web_root
+ errors = []
+ previous = (0, 0)
+ songs = 0
+ try:
+  web = imp.load_source("webleviathan",
+                        os.path.join(web_root, "webleviathan.py"))
+  while True:
+   done = stop.is_set()
+   try:
+    previous = _check_snapshot(web.library.snapshot(), previous, errors)
+    for category, query in WEB_LISTS:
+     environ = {}
+     wsgiref.util.setup_testing_defaults(environ)
+     environ["PATH_INFO"] = "/list/%s/list.json" % category
+     environ["QUERY_STRING"] = query
+     status = []
+     body = "".join(web.application(
+      environ, lambda s, headers, exc_info=None: status.append(s)
+     ))
+     if status[0] != "200 OK":
+      errors.append("/list/%s returned %s: %s" % (category, status[0], body))
+      continue
+     entries = json.loads(body)["entries"]
+     if category == "songs":
+      if len(entries) < songs:
+       errors.append("/list/songs went from %d to %d songs"
+                     % (songs, len(entries)))
+      songs = len(entries)
+   except Exception:
+    errors.append(traceback.format_exc())
+   if done:
+    break
+ except Exception:
+  errors.append(traceback.format_exc())
+ results.put((errors, songs))
+
+def _check_forked_connection(library, results):
+ # Runs in a child process that inherited library's connection for this
+ # thread, and puts whether the child opened its own connection and could
+ # read the library with it in results
+ inherited = library._local.conn
+ try:
+  conn = library._connect()
+  results.put((conn is not inherited, len(library.songs)))
+ except Exception:
+  results.put((traceback.format_exc(), None))
+
+class ConcurrencyTest(TemporaryLibraryMixin, unittest.TestCase):
+ SONG_COUNT = 300
+ READERS = 4
+ # Small enough that the scan commits many times while the readers run
+ BULK_BATCH_SIZE = 20
+ 
+ def setUp(self):
+  super(ConcurrencyTest, self).setUp()
+  leviathan.enable_gpl()
+  self.library = leviathan.Library(self.config)
+  self.addCleanup(self.library.close)
+  batch_size = leviathan.leviathan.BULK_BATCH_SIZE
+  self.addCleanup(setattr, leviathan.leviathan, "BULK_BATCH_SIZE", batch_size)
+  leviathan.leviathan.BULK_BATCH_SIZE = self.BULK_BATCH_SIZE
+ 
+ def _scan_with_readers(self, target, args):
+  # Scans the library while READERS processes run target(*args, stop,
+  # results), and checks that none of them failed (e.g. with "database is
+  # locked") or saw an inconsistent library, and that they all saw the
+  # finished library in the end
+  stop = multiprocessing.Event()
+  results = multiprocessing.Queue()
+  readers = [multiprocessing.Process(target=target,
+                                     args=args + (stop, results))
+             for i in range(self.READERS)]
+  for reader in readers:
+   reader.start()
+  try:
+   result = self.library.scan()
+  finally:
+   stop.set()
+   reader_results = [results.get(timeout=60) for reader in readers]
+   for reader in readers:
+    reader.join()
+  self.assertEqual(result.added, self.SONG_COUNT)
+  for errors, songs in reader_results:
+   self.assertEqual(errors, [])
+   self.assertEqual(songs, self.SONG_COUNT)
+ 
+ def test_scan_with_library_readers(self):
+  self._scan_with_readers(_read_library, (self.config,))
+ 
+ def test_scan_with_web_readers(self):
+  try:
+   import bottle
+   import PIL
+  except ImportError:
+   self.skipTest("the Web app's dependencies are not installed")
+  # The Web app reads its settings from the folder that it is in, so it is
+  # linked into a folder with settings for this library
+  web_root = os.path.join(self.root, "web")
+  os.mkdir(web_root)
+  for i in ("webleviathan.py", "views", "themes"):
+   os.symlink(os.path.join(ROOT, i), os.path.join(web_root, i))
+  config_path = os.path.join(self.root, "leviathan.yaml")
+  with open(config_path, "w") as f:
+   yaml.safe_dump(self.config, f)
+  with open(os.path.join(web_root, "webleviathan.yaml"), "w") as f:
+   yaml.safe_dump({"leviathan.yaml": config_path, "theme": "Radiance",
+                   "last.fm": dict(username=None, password=None)}, f)
+  self._scan_with_readers(_read_web_lists, (web_root,))
+ 
+ def test_forked_process_opens_own_connection(self):
+  # Forked Web server workers must not share the connection that the
+  # master process opened when it loaded the Web app
+  self.library.scan()
+  self.library._connect()
+  results = multiprocessing.Queue()
+  child = multiprocessing.Process(target=_check_forked_connection,
+                                  args=(self.library, results))
+  child.start()
+  result = results.get(timeout=60)
+  child.join()
+  self.assertEqual(result, (True, self.SONG_COUNT))
+  # The parent's connection still works
+  self.assertEqual(len(self.library.songs), self.SONG_COUNT)
+
+if __name__ == "__main__":
+ unittest.main()
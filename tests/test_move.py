@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+import os
+import unittest
+
+import leviathan
+
+from tests import TemporaryLibraryMixin
+
+class MoveTest(TemporaryLibraryMixin, unittest.TestCase):
+ def setUp(self):
+  super(MoveTest, self).setUp()
+  leviathan.enable_gpl()
+  self.library = leviathan.Library(self.config)
+  self.addCleanup(self.library.close)
+  self.library.scan()
+ 
+ def _relpaths(self):
+  return sorted(i.relpath for i in self.library.songs)
+ 
+ def _check_move(self, src, dst):
+  # Moves the folder at src to dst and checks that exactly the songs in it
+  # were moved, to the files that they were moved to
+  before = self._relpaths()
+  expected = sorted(dst + i[len(src):] if i.startswith(src + "/") else i
+                    for i in before)
+  self.library.move(os.path.join(self.library.music_path, src),
+                    os.path.join(self.library.music_path, dst))
+  after = self._relpaths()
+  self.assertNotEqual(after, before)
+  self.assertEqual(after, expected)
+  for relpath in after:
+   self.assertTrue(os.path.isfile(os.path.join(self.library.music_path,
+                                               relpath)), relpath)
+ 
+ def test_move_folder(self):
+  self._check_move(u"Björk", u"Bjork")
+ 
+ def test_move_folder_outside_bmp(self):
+  # Characters outside the Basic Multilingual Plane are two code units long
+  # in narrow Python builds, but one character long in SQLite
+  self._check_move(u"Björk", u"Björk \U0001d11e")
+  self._check_move(u"Björk \U0001d11e", u"\U0001f3b5 Björk")
+
+if __name__ == "__main__":
+ unittest.main()
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import os
+import unittest
+
+import leviathan
+
+from tests import TemporaryLibraryMixin
+
+class RebuildTest(TemporaryLibraryMixin, unittest.TestCase):
+ def setUp(self):
+  super(RebuildTest, self).setUp()
+  leviathan.enable_gpl()
+  self.library = leviathan.Library(self.config)
+  self.addCleanup(self.library.close)
+  self.library.scan()
+  self.library.playlists.add(u"Mix")
+  for song in list(self.library.songs)[:10]:
+   self.library.playlists[u"Mix"].add_song(song)
+  self.library.query(self.library.queries["set_meta"], key="custom",
+                     value="value")
+ 
+ def _check_rebuild(self, library):
+  # Rebuilds library and checks that a reader that had the old database
+  # open sees the new one
+  interval = leviathan.leviathan.DB_REPLACED_CHECK_INTERVAL
+  self.addCleanup(setattr, leviathan.leviathan, "DB_REPLACED_CHECK_INTERVAL",
+                  interval)
+  leviathan.leviathan.DB_REPLACED_CHECK_INTERVAL = 0
+  reader = leviathan.Library(self.config)
+  self.addCleanup(reader.close)
+  generation = reader.generation
+  library.query("""DELETE FROM songs WHERE id = (SELECT max(id) FROM songs)""")
+  self.assertEqual(len(library.songs), self.SONG_COUNT - 1)
+  result = library.rebuild()
+  self.assertEqual(result.added, self.SONG_COUNT)
+  self.assertEqual(len(reader.songs), self.SONG_COUNT)
+  self.assertTrue(reader.generation > generation)
+  self.assertEqual(reader.get_meta("custom"), "value")
+  self.assertEqual(len(reader.playlists[u"Mix"].songs), 10)
+  path = os.path.realpath(self.config["database_path"])
+  self.assertFalse(os.path.islink(path))
+  # Only the lock file is left behind
+  for i in os.listdir(os.path.dirname(path)):
+   self.assertFalse(i.startswith(os.path.basename(path) + ".") and
+                    not i.endswith(".lock"), i)
+ 
+ def test_rebuild(self):
+  self._check_rebuild(self.library)
+ 
+ def test_rebuild_through_symlink(self):
+  # The file that a symlink points to is replaced, not the symlink
+  path = self.config["database_path"]
+  target = os.path.join(self.root, "real.sqlite")
+  self.library.close()
+  os.rename(path, target)
+  for i in ("-wal", "-shm"):
+   if os.path.exists(path + i):
+    os.rename(path + i, target + i)
+  os.symlink(target, path)
+  self._check_rebuild(self.library)
+  self.assertEqual(os.readlink(path), target)
+ 
+ def test_rebuild_refuses_while_scanning(self):
+  # Another Library stands in for a scan or watcher in another process
+  other = leviathan.Library(self.config)
+  self.addCleanup(other.close)
+  lock = other._lock_writers()
+  try:
+   self.assertRaises(Exception, self.library.rebuild)
+  finally:
+   lock.close()
+  self.assertEqual(len(self.library.songs), self.SONG_COUNT)
+ 
+ def test_scan_refuses_while_rebuilding(self):
+  lock = self.library._lock_writers(exclusive=True)
+  try:
+   self.assertRaises(Exception, leviathan.Library(self.config).scan)
+  finally:
+   lock.close()
+
+if __name__ == "__main__":
+ unittest.main()
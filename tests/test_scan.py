@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import StringIO
+import sys
+import unittest
+
+import leviathan
+
+from tests import TemporaryLibraryMixin
+
+class ScanTest(TemporaryLibraryMixin, unittest.TestCase):
+ def setUp(self):
+  super(ScanTest, self).setUp()
+  leviathan.enable_gpl()
+  self.library = leviathan.Library(self.config)
+  self.addCleanup(self.library.close)
+  self.library.scan()
+  self.library.playlists.add(u"Mix")
+  for song in list(self.library.songs)[:10]:
+   self.library.playlists[u"Mix"].add_song(song)
+ 
+ def _scan(self, **kwargs):
+  # Scans the library and returns the result and what was written to
+  # standard error
+  stderr = sys.stderr
+  sys.stderr = StringIO.StringIO()
+  try:
+   return self.library.scan(**kwargs), sys.stderr.getvalue()
+  finally:
+   sys.stderr = stderr
+ 
+ def _empty_music_folder(self):
+  # Leaves the music folder empty, like an unmounted mountpoint
+  shutil.move(self.library.music_path, os.path.join(self.root, "unmounted"))
+  os.mkdir(self.library.music_path)
+ 
+ def test_removes_some_missing_songs(self):
+  relpaths = sorted(i.relpath for i in self.library.songs)[:10]
+  for i in relpaths:
+   os.remove(os.path.join(self.library.music_path, i))
+  result, stderr = self._scan()
+  self.assertEqual(result.removed, len(relpaths))
+  self.assertEqual(stderr, "")
+  self.assertEqual(len(self.library.songs), self.SONG_COUNT - len(relpaths))
+ 
+ def test_empty_music_folder_does_not_prune(self):
+  self._empty_music_folder()
+  result, stderr = self._scan()
+  self.assertEqual(result.removed, 0)
+  self.assertIn("warning:", stderr)
+  self.assertEqual(len(self.library.songs), self.SONG_COUNT)
+  self.assertEqual(len(self.library.playlists[u"Mix"].songs), 10)
+ 
+ def test_prune_removes_missing_songs(self):
+  self._empty_music_folder()
+  result, stderr = self._scan(prune=True)
+  self.assertEqual(result.removed, self.SONG_COUNT)
+  self.assertEqual(len(self.library.songs), 0)
+
+if __name__ == "__main__":
+ unittest.main()
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import leviathan
+
+from tests import TemporaryLibraryMixin
+
+class SearchTest(TemporaryLibraryMixin, unittest.TestCase):
+ def setUp(self):
+  super(SearchTest, self).setUp()
+  leviathan.enable_gpl()
+  self.library = leviathan.Library(self.config)
+  self.addCleanup(self.library.close)
+  self.library.scan()
+ 
+ def _search_like(self, value):
+  # sort_title is not in the full-text search index, so searching it always
+  # uses a LIKE query
+  songs = self.library.songs.search("sort_title", value, exact=False)
+  return sorted(i.sort_title for i in songs)
+ 
+ def test_like_matches_substrings(self):
+  titles = self._search_like(u"ng 1")
+  self.assertTrue(titles)
+  self.assertTrue(all(u"ng 1" in i for i in titles))
+ 
+ def test_like_escapes_wildcards(self):
+  # Unescaped, "%" would match every song and "_" any character
+  self.assertEqual(self._search_like(u"%"), [])
+  self.assertEqual(self._search_like(u"g_1"), [])
+  self.assertEqual(self._search_like(u"\\"), [])
+  self.library.query("""UPDATE songs SET sort_title = '100% g_1\\'
+                        WHERE id = (SELECT min(id) FROM songs)""")
+  for value in (u"%", u"0% g_", u"g_1\\"):
+   self.assertEqual(self._search_like(value), [u"100% g_1\\"])
+
+if __name__ == "__main__":
+ unittest.main()
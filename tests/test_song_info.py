@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+import multiprocessing.pool
+import os
+import unittest
+
+import leviathan
+
+from tests import TemporaryLibraryMixin
+
+class SongInfoTest(TemporaryLibraryMixin, unittest.TestCase):
+ THREADS = 8
+ 
+ def setUp(self):
+  super(SongInfoTest, self).setUp()
+  leviathan.enable_gpl()
+  self.library = leviathan.Library(self.config)
+  self.addCleanup(self.library.close)
+  self.relpaths = sorted(self.library.songs._find_relpaths())
+ 
+ def test_parallel_matches_serial(self):
+  # _get_song_info must not depend on the working directory or other
+  # process-wide state, since scans and the watcher call it from threads
+  cwd = os.getcwd()
+  expected = [self.library._get_song_info(i) for i in self.relpaths]
+  pool = multiprocessing.pool.ThreadPool(self.THREADS)
+  try:
+   # Each path is read several times so that the threads overlap
+   actual = pool.map(self.library._get_song_info, self.relpaths * 4, 1)
+  finally:
+   pool.close()
+   pool.join()
+  self.assertEqual(actual, expected * 4)
+  self.assertEqual(os.getcwd(), cwd)
+ 
+ def test_info(self):
+  relpath = os.path.join(u"Björk", u"Album 1", u"001 song.mp3")
+  info = self.library._get_song_info(relpath)
+  self.assertEqual(info[0], relpath)
+  self.assertEqual(info[1], u"Sóng 1")
+  self.assertEqual(info[3], u"Björk")
+  self.assertEqual(info[5], u"Album 1")
+  self.assertEqual((info[8], info[9]), (1, 2))
+ 
+ def test_scan_with_threads_running(self):
+  # A scan in one thread and _get_song_info calls in others see the same
+  # files
+  pool = multiprocessing.pool.ThreadPool(self.THREADS)
+  try:
+   infos = pool.map_async(self.library._get_song_info, self.relpaths, 1)
+   result = self.library.scan()
+   infos = infos.get()
+  finally:
+   pool.close()
+   pool.join()
+  self.assertEqual(result.added, len(self.relpaths))
+  for info in infos:
+   song = self.library.songs[info[0]]
+   self.assertEqual((song.title, song.artist, song.album),
+                    (info[1], info[3], info[5]))
+
+if __name__ == "__main__":
+ unittest.main()
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+import random
+import unicodedata
+import unittest
+
+import leviathan
+
+# Characters that the random corpus is made of:  every variant in
+# LATIN_DIACRITICS and its NFD form, combining marks, compatibility characters
+# that NFKC changes, non-Latin letters, and plain ASCII
+CORPUS_CHARACTERS = sorted(set(
+ u"".join(leviathan.LATIN_DIACRITICS.values()) +
+ unicodedata.normalize("NFD", u"".join(leviathan.LATIN_DIACRITICS.values())) +
+ u"".join(unichr(i) for i in range(0x300, 0x370)) +
+ u"ﬁﬂﬀ²½ℌℕ™ＡＢｃ①ǅǈǋ" +
+ u"ΑβΓδЖжЯяあア中文한국어ßẞæœŒđÐþÞıİ" +
+ u"abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 ,.'-"
+))
+# Words that the corpus's strings sometimes start with, since sort_value moves
+# articles to the end
+CORPUS_PREFIXES = (u"", u"The ", u"the ", u"THE ", u"A ", u"a ", u"An ", u"an ",
+                   u"Ánd ", u"Thé ")
+CORPUS_SIZE = 5000
+
+def old_strip_latin_diacritics(source):
+ # strip_latin_diacritics before it used LATIN_DIACRITICS_TABLE
+ ret = unicodedata.normalize("NFKC", leviathan.to_unicode(source))
+ for letter in leviathan.LATIN_DIACRITICS:
+  for variant in leviathan.LATIN_DIACRITICS[letter]:
+   ret = ret.replace(variant, letter)
+ return ret
+
+def old_sort_value(s):
+ # sort_value before it used a cache
+ s = leviathan.to_unicode(old_strip_latin_diacritics(s)).lower()
+ if s.startswith("the "):
+  s = s.replace("the ", "", 1) + ", the"
+ elif s.startswith("an "):
+  s = s.replace("an ", "", 1) + ", an"
+ elif s.startswith("a "):
+  s = s.replace("a ", "", 1) + ", a"
+ return s
+
+def make_corpus(seed=0):
+ # Returns CORPUS_SIZE random strings, plus each corpus character on its own
+ rng = random.Random(seed)
+ corpus = list(CORPUS_CHARACTERS)
+ for i in range(CORPUS_SIZE):
+  length = rng.randint(0, 12)
+  corpus.append(rng.choice(CORPUS_PREFIXES) +
+                u"".join(rng.choice(CORPUS_CHARACTERS) for j in range(length)))
+ return corpus
+
+class SortValueTest(unittest.TestCase):
+ @classmethod
+ def setUpClass(cls):
+  # The old functions are slow, so their results are only computed once
+  cls.corpus = make_corpus()
+  cls.old_stripped = [old_strip_latin_diacritics(s) for s in cls.corpus]
+  cls.old_sort_values = [old_sort_value(s) for s in cls.corpus]
+ 
+ def setUp(self):
+  self.addCleanup(leviathan.leviathan._sort_value_cache.clear)
+  leviathan.leviathan._sort_value_cache.clear()
+ 
+ def test_strip_latin_diacritics_matches_old(self):
+  for s, expected in zip(self.corpus, self.old_stripped):
+   self.assertEqual(leviathan.strip_latin_diacritics(s), expected, repr(s))
+ 
+ def test_sort_value_matches_old(self):
+  # Twice, so that the second pass gets the cached values
+  for i in range(2):
+   for s, expected in zip(self.corpus, self.old_sort_values):
+    self.assertEqual(leviathan.sort_value(s), expected, repr(s))
+ 
+ def test_sort_value_accepts_utf8(self):
+  for s, expected in zip(self.corpus, self.old_sort_values):
+   self.assertEqual(leviathan.sort_value(s.encode("utf8")), expected, repr(s))
+ 
+ def test_sort_value_cache_is_bounded(self):
+  for s in self.corpus:
+   leviathan.sort_value(s)
+  self.assertTrue(len(leviathan.leviathan._sort_value_cache) <=
+                  leviathan.leviathan.SORT_VALUE_CACHE_SIZE)
+
+if __name__ == "__main__":
+ unittest.main()
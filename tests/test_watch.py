@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import leviathan
+
+from tests import TemporaryLibraryMixin
+
+class WatchTest(TemporaryLibraryMixin, unittest.TestCase):
+ def setUp(self):
+  super(WatchTest, self).setUp()
+  leviathan.enable_gpl()
+  self.library = leviathan.Library(self.config)
+  self.addCleanup(self.library.close)
+  self.watcher = leviathan.LibraryWatcher(self.library)
+ 
+ def test_apply(self):
+  self.watcher.poll()
+  self.assertTrue(self.watcher.pending)
+  result = self.watcher.apply()
+  self.assertEqual(result.added, self.SONG_COUNT)
+  self.assertFalse(self.watcher.pending)
+  self.assertEqual(len(self.library.songs), self.SONG_COUNT)
+ 
+ def test_failed_apply_keeps_changes(self):
+  # A song that cannot be read partway through stops the batch after some of
+  # it was committed; the whole batch is applied again the next time
+  batch_size = leviathan.leviathan.BULK_BATCH_SIZE
+  self.addCleanup(setattr, leviathan.leviathan, "BULK_BATCH_SIZE", batch_size)
+  leviathan.leviathan.BULK_BATCH_SIZE = 10
+  get_song_info_and_hash = self.library._get_song_info_and_hash
+  calls = []
+  def fail_once(relpath):
+   calls.append(relpath)
+   if len(calls) == self.SONG_COUNT // 2:
+    raise IOError("the song could not be read")
+   return get_song_info_and_hash(relpath)
+  self.library._get_song_info_and_hash = fail_once
+  self.watcher.poll()
+  self.assertRaises(IOError, self.watcher.apply)
+  self.assertTrue(self.watcher.pending)
+  self.assertTrue(0 < len(self.library.songs) < self.SONG_COUNT)
+  self.watcher.apply()
+  self.assertFalse(self.watcher.pending)
+  self.assertEqual(len(self.library.songs), self.SONG_COUNT)
+  self.assertEqual(
+   sorted(i.relpath for i in self.library.songs),
+   sorted(self.library.songs._find_relpaths())
+  )
+
+if __name__ == "__main__":
+ unittest.main()
@@ -75,6 +75,7 @@ DEFAULT_THEME      = "Radiance"
 FSENC              = leviathan.getfilesystemencoding()
 LAST_FM_API_KEY    = "564bfe2575a418e90e6977cfc71d7fbe"
 LAST_FM_API_SECRET = "164dd907b69d8b50d047ba66d233249e"
+SEARCH_LIMIT       = 50
 SETTINGS_FILE      = "webleviathan.yaml"
 
 class _GeventServer(ServerAdapter):
@@ -213,9 +214,14 @@ def get_dom_id(category, id, parent=None):
  dom_id = category + "_" + hashlib.sha1(dom_id).hexdigest()
  return dom_id
 
-def get_list(category, id=None, queue=None):
+def get_list(category, id=None, queue=None, snapshot=None):
  # Format: (id, name, Song object) unless otherwise specified
  # id is the same as name for artists and albums
+ # snapshot should be the one that the rest of the request uses, so that the
+ # response comes from a single version of the library.  Searches query the
+ # database directly.
+ if snapshot == None and category != "search":
+  snapshot = library.snapshot()
  if category == "queue":
   cookies = getattr(request, "cookies", getattr(request, "COOKIES"))
   if queue == None:
@@ -229,31 +235,44 @@ def get_list(category, id=None, queue=None):
     queue = cookies["queue"].split(":")
    else:
     queue = []
-  l = [library.songs[int(i)] for i in queue if i != ""]
+  l = [snapshot.song(int(i)) for i in queue if i != ""]
   return [(i.id, i.title, i) for i in l]
  elif category == "artist":
-  return [(i.id, i.title, i) for i in library.artists[id].songs]
+  return [(i.id, i.title, i) for i in snapshot.artist(id).songs]
  elif category == "artists":
   # Format: (name, name, None)
-  return [(i.name, i.name, None) for i in library.artists]
+  return [(i.name, i.name, None) for i in snapshot.artists]
  elif category == "album":
-  album = library.albums(artist=id[0], album=id[1])
+  album = snapshot.album(artist=id[0], album=id[1])
   return [(i.id, i.title, i) for i in album.songs]
  elif category == "albums":
   # Format: ("artistname_albumname", display name, tuple(artist, name))
   return [("%s_%s" % (i.artist, i.name),
            i.name if id
             else "%s - %s" % (i.name or "(Unknown)", i.artist or "(Unknown)"),
-           (i.artist, i.name)) for i in library.albums(artist=id)]
+           (i.artist, i.name))
+          for i in (snapshot.artist_albums(id) if id else snapshot.albums)]
  elif category == "playlist":
-  return [(i.id, i.title, i) for i in library.playlists[int(id)].songs]
+  return [(i.id, i.title, i) for i in snapshot.playlist(int(id)).songs]
  elif category == "playlists":
   # Format: (id, name, None)
-  return [(i.id, i.name, None) for i in library.playlists]
+  return [(i.id, i.name, None) for i in snapshot.playlists]
+ elif category == "search":
+  # id is the search term
+  if not id:
+   return []
+  try:
+   limit = int(request.GET.get("limit", SEARCH_LIMIT))
+  except ValueError:
+   limit = SEARCH_LIMIT
+  # SQLite treats a negative limit as no limit
+  limit = max(1, min(limit, SEARCH_LIMIT))
+  return [(i.id, i.title, i) for i in
+          library.songs.search(None, id, exact=False, sort="rank", limit=limit)]
  elif category == "song":
-  return [(i.id, i.title, i) for i in [library.songs[int(id)]]]
+  return [(i.id, i.title, i) for i in [snapshot.song(int(id))]]
  elif category == "songs":
-  return [(i.id, i.title, i) for i in library.songs]
+  return [(i.id, i.title, i) for i in snapshot.songs]
 
 @route("/")
 @view("index")
@@ -279,25 +298,29 @@ def library(relpath):
 
 def list_category(category, format=""):
  artist, id = request.GET.get("artist"), request.GET.get("id")
+ if category == "search":
+  id = request.GET.get("q", id)
  artist = to_unicode(artist) if artist != None else artist
  id = to_unicode(id) if id != None else id
  parent = request.GET.get("parent")
  if category == "album":
   id = (artist, id)
  if id != None and category not in ("artist", "album", "albums", "playlist",
-                                    "song"):
+                                    "search", "song"):
   id = None
  if category in ("queue", "artist", "artists", "album", "albums", "playlist",
-                 "playlists", "song", "songs"):
+                 "playlists", "search", "song", "songs"):
+  snapshot = library.snapshot() if category != "search" else None
   l = []
-  for i in get_list(category, id):
+  for i in get_list(category, id, snapshot=snapshot):
    quoted_id = quote(to_unicode(i[0]).encode("utf8"), "")
    dom_id = get_dom_id(category, i[0], parent)
    info = ((i[2] if isinstance(i[2], leviathan.Song) else
             [quote(to_unicode(j).encode("utf8"), "") for j in i[2]])
            if i[2] else None)
    name = full_name = to_unicode(i[1]) if i[1] else "(Unknown)"
-   if category in ("artist", "album", "playlist", "queue", "song", "songs"):
+   if category in ("artist", "album", "playlist", "queue", "search", "song",
+                   "songs"):
     full_name = u"%s — %s" % (i[1] or "(Unknown)",
                               (info.artist or "(Unknown)") if i else "")
     if category != "album":
@@ -318,7 +341,7 @@ def list_category(category, format=""):
     song = None
    if category == "albums":
     try:
-     album = library.albums(artist=i[2][0], album=i[2][1])
+     album = snapshot.album(artist=i[2][0], album=i[2][1])
      art_relpath = os.path.dirname(album.songs[0].relpath)
      art_url = root_url() + "/artwork/" + quote(art_relpath.encode("utf8"))
      icon = art_url + "/album.png?size=16"
@@ -353,10 +376,20 @@ def list_themes():
  themes.sort()
  return themes
 
+@route("/scan-status.json")
+def scan_status():
+ # updated is the time of the last progress report, since an interrupted
+ # scan leaves its last one behind
+ progress = library.scan_progress()
+ if progress == None:
+  return dict(scanning=False)
+ return dict(progress._asdict(), scanning=True, rate=progress.rate,
+             eta=progress.eta)
+
 @route("/scrobble/:id")
 def scrobble(id):
  timestamp = int(request.GET.get("timestamp", round(time.time())))
- song = library.songs[int(id)]
+ song = library.snapshot().song(int(id))
  lfm = last_fm_login()
  if song.artist and song.title:
   optional = {}
@@ -367,6 +400,10 @@ def scrobble(id):
    optional["duration"] = int(duration)
   lfm.scrobble(song.artist, song.title, timestamp, **optional)
 
+@route("/search")
+def search():
+ return list_category("search", "json")
+
 def settings():
  return load_yaml_file(SETTINGS_FILE)
 
@@ -402,7 +439,7 @@ def to_unicode(s, encoding="utf8"):
 
 @route("/update-now-playing/:id")
 def update_now_playing(id):
- song = library.songs[int(id)]
+ song = library.snapshot().song(int(id))
  lfm = last_fm_login()
  if song.artist and song.title:
   optional = {}
@@ -432,6 +469,11 @@ def error_404(unknown):
 leviathan_cfg_path = to_unicode(settings()["leviathan.yaml"])
 leviathan_cfg_path = os.path.normpath(os.path.expanduser(leviathan_cfg_path))
 library = leviathan.Library(leviathan_cfg_path)
+# Load the snapshot now so that the first request does not have to.  The
+# connection is closed afterwards so that forked workers (e.g. uWSGI's) do
+# not share it; they open their own and keep the loaded snapshot.
+library.snapshot()
+library.close()
 
 application = app()
 